@@ -1,9 +1,15 @@
 # app.py
 import os
-import uuid
+import json
+import time
+import threading
+from collections import OrderedDict
 import requests
-from flask import Flask, request, jsonify, send_from_directory, render_template
+from flask import Flask, Response, g, request, jsonify, send_file, render_template, stream_with_context
 from dotenv import load_dotenv
+import metrics
+from lyrics_service import LyricsError, LyricsService, TopicCache, make_backend
+from artifact_store import ArtifactStore
 
 load_dotenv()
 
@@ -13,15 +19,57 @@ COLAB_API_BASE  = os.getenv("COLAB_API_BASE")
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
 
+# 가사 생성 백엔드: openai (OpenAI 호환 API, LYRICS_API_BASE 로 픽스처 서버도 지정 가능) / local (네트워크 없는 대체 모델)
+LYRICS_BACKEND       = os.getenv("LYRICS_BACKEND", "openai")
+LYRICS_API_BASE      = os.getenv("LYRICS_API_BASE", "https://api.openai.com/v1")
+LYRICS_MODEL         = os.getenv("LYRICS_MODEL", "gpt-3.5-turbo")
+LYRICS_TIMEOUT       = float(os.getenv("LYRICS_TIMEOUT", "60"))
+# 같은 주제(공백/대소문자 정규화)의 가사는 LYRICS_CACHE_TTL 초 동안 다시 생성하지 않는다
+LYRICS_CACHE_ENTRIES = int(os.getenv("LYRICS_CACHE_ENTRIES", "256"))
+LYRICS_CACHE_TTL     = float(os.getenv("LYRICS_CACHE_TTL", "3600"))
+
+if LYRICS_BACKEND == "openai":
+    _lyrics_backend = make_backend("openai", api_key=OPENAI_API_KEY, model=LYRICS_MODEL,
+                                   base_url=LYRICS_API_BASE, timeout=LYRICS_TIMEOUT)
+else:
+    _lyrics_backend = make_backend(LYRICS_BACKEND, token_delay=float(os.getenv("LYRICS_LOCAL_TOKEN_DELAY", "0")))
+lyrics_service = LyricsService(_lyrics_backend, TopicCache(LYRICS_CACHE_ENTRIES, LYRICS_CACHE_TTL))
+
 RESULT_DIR = './results'
-os.makedirs(RESULT_DIR, exist_ok=True)
+# 결과물 보관 한도: 전체 크기(GB) / 보관 기간(시간), 0 이면 제한 없음. 넘으면 오래된 것부터 지운다
+RESULT_MAX_GB        = float(os.getenv("RESULT_MAX_GB", "5"))
+RESULT_MAX_AGE_HOURS = float(os.getenv("RESULT_MAX_AGE_HOURS", "72"))
+artifact_store = ArtifactStore(RESULT_DIR, max_bytes=int(RESULT_MAX_GB * 1024**3), max_age=RESULT_MAX_AGE_HOURS * 3600)
+artifact_store.evict()
+
+# colab job id -> 로컬에 저장된 결과 파일 이름 + colab 의 결과물 경로
+# (로컬 파일이 보관 한도로 지워지면 그 경로에서 다시 받는다). SONG_RESULTS_MAX 개를 넘으면 가장 오래 안 쓴 것부터 잊는다
+SONG_RESULTS_MAX = int(os.getenv("SONG_RESULTS_MAX", "4096"))
+_song_results = OrderedDict()
+_song_download_locks = {}
+_song_results_lock = threading.Lock()
+
+# 요청마다 엔드포인트별 응답 시간 / 상태 코드를 /metrics 에 남긴다
+# (스트리밍 응답은 첫 응답을 돌려줄 때까지의 시간)
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    started = g.pop("request_started", None)
+    if started is not None and request.endpoint != "metrics_endpoint":
+        endpoint = request.endpoint or "unknown"
+        metrics.REGISTRY.observe("http_request_seconds", time.perf_counter() - started, endpoint=endpoint)
+        metrics.REGISTRY.inc("http_requests_total", endpoint=endpoint, status=response.status_code)
+    return response
 
 # 0) 메인 페이지
 @app.route('/')
 def index():
     return render_template('index.html')
 
-# 1) 가사 생성
+# 1) 가사 생성 (한 번에 받기)
 @app.route("/generate-lyrics", methods=["POST"])
 def generate_lyrics():
     data = request.get_json() or {}
@@ -29,18 +77,32 @@ def generate_lyrics():
     if not topic:
         return jsonify({"lyrics": ""})
 
-    import openai
-    openai.api_key = OPENAI_API_KEY
-    prompt = f"'{topic}'라는 주제로 16마디 분량의 한국어 노래 가사를 만들어줘. 운율과 구성을 신경 써서 작성해줘."
-    res = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role":"user", "content": prompt}],
-        max_tokens=256,
-        temperature=0.8
-    )
-    lyrics = res.choices[0].message.content.strip()
+    try:
+        lyrics = lyrics_service.generate(topic)
+    except LyricsError as e:
+        return jsonify({"error": f"가사 생성 실패: {e}"}), 502
     return jsonify({"lyrics": lyrics})
 
+# 1-1) 가사 생성 SSE 스트림: token 이벤트로 생성되는 대로 보내고 done / failed 로 끝난다
+@app.route("/generate-lyrics/stream")
+def generate_lyrics_stream():
+    topic = request.args.get("topic", "").strip()
+
+    def events():
+        try:
+            if topic:
+                for token in lyrics_service.stream(topic):
+                    yield sse_event("token", {"text": token})
+        except LyricsError as e:
+            yield sse_event("failed", {"error": f"가사 생성 실패: {e}"})
+            return
+        yield sse_event("done", {})
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 # 2) 노래 생성 (멜로디+보컬 → MP3 파일 & 악보 PDF 파일 생성)
 @app.route("/generate-song", methods=["POST"])
 def generate_song():
@@ -60,46 +122,121 @@ def generate_song():
         # style, tempo, accompaniment 를 colab 쪽에서 쓴다면 여기에 추가로 넘기시면 됩니다.
     }
 
-    # 2-1) MP3 생성
+    # 2-1) colab 서버에 job 등록 -> job id 만 받고 바로 응답 (생성은 백그라운드)
     try:
-        r_mp3 = requests.post(
-            f"{COLAB_API_BASE}/generate?file=mp3",
-            files=files, timeout=300
-        )
-        r_mp3.raise_for_status()
+        r = requests.post(f"{COLAB_API_BASE}/jobs", files=files, timeout=30)
+        r.raise_for_status()
     except Exception as e:
-        return jsonify({"error": f"음악 생성 실패: {e}"}), 500
-
-    # 2-2) PDF(악보) 생성
+        return jsonify({"error": f"음악 생성 요청 실패: {e}"}), 500
+
+    return jsonify({"job_id": r.json()["job_id"]}), 202
+
+# 2-2) 생성 상태 조회 (페이지에서 주기적으로 폴링)
+@app.route("/song-jobs/<job_id>")
+def song_job_status(job_id):
+    with _song_results_lock:
+        entry = _song_results.get(job_id)
+        if entry is not None:
+            _song_results.move_to_end(job_id)
+    if entry is not None and result_present(entry["result"]):
+        return jsonify(dict(status="done", **entry["result"]))
+
+    if entry is not None:
+        # 보관 한도로 지워진 결과물은 저장해 둔 경로로 바로 다시 받는다
+        # (colab 은 끝난 job 을 일정 시간 뒤 잊지만 /artifacts/<job id>/... 는 계속 내준다)
+        artifacts = entry["artifacts"]
+    else:
+        try:
+            r = requests.get(f"{COLAB_API_BASE}/jobs/{job_id}", timeout=30)
+            r.raise_for_status()
+            job = r.json()
+        except Exception as e:
+            return jsonify({"error": f"상태 조회 실패: {e}"}), 500
+
+        if job["status"] == "failed":
+            return jsonify({"status": "failed", "error": f"음악 생성 실패: {job['error']}"}), 500
+        if job["status"] != "done":
+            return jsonify({"status": job["status"], "progress": job["progress"]})
+        artifacts = {name: path for name, path in job["artifacts"].items() if name in ("mp3", "pdf")}
+
+    # 2-3) 완료된 job 의 결과물을 한 번만 받아서 로컬에 저장 (job 별 lock)
+    with _song_results_lock:
+        job_lock = _song_download_locks.setdefault(job_id, threading.Lock())
+    try:
+        with job_lock:
+            with _song_results_lock:
+                entry = _song_results.get(job_id)
+            if entry is None or not result_present(entry["result"]):
+                try:
+                    with metrics.span("artifact_download"):
+                        result = download_artifacts(artifacts)
+                except Exception as e:
+                    return jsonify({"error": f"결과물 다운로드 실패: {e}"}), 500
+                entry = {"result": result, "artifacts": artifacts}
+                with _song_results_lock:
+                    _song_results[job_id] = entry
+                    _song_results.move_to_end(job_id)
+                    while len(_song_results) > SONG_RESULTS_MAX:
+                        _song_results.popitem(last=False)
+    finally:
+        with _song_results_lock:
+            _song_download_locks.pop(job_id, None)
+    return jsonify(dict(status="done", **entry["result"]))
+
+def result_present(result):
+    # 로컬 결과물이 보관 한도로 지워지지 않고 남아 있는지
+    return all(artifact_store.path(name) is not None for name in result.values() if name is not None)
+
+# 2-4) 생성 중 미리듣기: colab 의 오디오 스트림을 받는 대로 그대로 중계
+@app.route("/song-jobs/<job_id>/stream")
+def song_job_stream(job_id):
     try:
-        r_pdf = requests.post(
-            f"{COLAB_API_BASE}/generate?file=pdf",
-            files=files, timeout=300
-        )
-        r_pdf.raise_for_status()
+        r = requests.get(f"{COLAB_API_BASE}/jobs/{job_id}/stream", stream=True, timeout=(10, 300))
+        r.raise_for_status()
     except Exception as e:
-        return jsonify({"error": f"악보 생성 실패: {e}"}), 500
-
-    # 3) 로컬에 저장
-    audio_name = f"{uuid.uuid4()}.mp3"
-    pdf_name   = f"{uuid.uuid4()}.pdf"
-    audio_path = os.path.join(RESULT_DIR, audio_name)
-    pdf_path   = os.path.join(RESULT_DIR, pdf_name)
-
-    with open(audio_path, "wb") as f:
-        f.write(r_mp3.content)
-    with open(pdf_path, "wb") as f:
-        f.write(r_pdf.content)
-
-    return jsonify({
-        "audio_path": audio_name,
-        "score_path": pdf_name
-    })
+        return jsonify({"error": f"스트림 연결 실패: {e}"}), 502
+
+    def relay():
+        try:
+            yield from r.iter_content(chunk_size=16384)
+        finally:
+            r.close()
+    return Response(stream_with_context(relay()), content_type=r.headers.get("Content-Type", "audio/wav"),
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def download_artifacts(artifacts):
+    # 3) 받는 대로 청크 단위로 로컬에 저장 (크기 / sha256 은 artifact_store 메타데이터에)
+    audio = fetch_artifact(artifacts["mp3"], ".mp3")
+    score = fetch_artifact(artifacts["pdf"], ".pdf") if "pdf" in artifacts else None
+    return {
+        "audio_path": audio["name"],
+        "score_path": score["name"] if score is not None else None
+    }
 
-# 3) 파일 다운로드
+def fetch_artifact(path, suffix):
+    r = requests.get(f"{COLAB_API_BASE}{path}", stream=True, timeout=(10, 300))
+    try:
+        r.raise_for_status()
+    except Exception:
+        r.close()
+        raise
+    return artifact_store.save_response(r, suffix, source=path)
+
+# 3) Prometheus 지표: 엔드포인트별 응답 시간, 가사 생성 / 결과물 다운로드 시간
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+# 4) 파일 다운로드: Range / If-None-Match / If-Modified-Since 를 지원해서
+#    오디오 플레이어가 다시 받지 않고 탐색할 수 있다 (파일 이름이 매번 새 UUID 라 내용은 바뀌지 않는다)
 @app.route("/download/<path:filename>")
 def download_file(filename):
-    return send_from_directory(RESULT_DIR, filename, as_attachment=True)
+    meta = artifact_store.meta(filename)
+    if meta is None:
+        return jsonify({"error": "파일 없음"}), 404
+    return send_file(artifact_store.path(filename), mimetype=meta["content_type"], as_attachment=True,
+                     download_name=filename, conditional=True, etag=meta["sha256"] or True,
+                     last_modified=meta["created_at"], max_age=86400)
 
 if __name__ == "__main__":
     # 디버그 모드로 5000번 포트 실행
@@ -0,0 +1,115 @@
+# artifact_store.py
+# 로컬 결과물(MP3/PDF) 저장소. colab 서버의 응답을 청크 단위로 바로 디스크에 써서
+# 곡 길이와 상관없이 요청당 메모리를 일정하게 쓰고, 파일마다 크기 / sha256 / Content-Type 을
+# <이름>.meta.json 에 남긴다. 보관 기간(max_age)이나 전체 크기(max_bytes)를 넘으면 오래된 것부터 지운다.
+import os
+import json
+import time
+import uuid
+import hashlib
+import tempfile
+import threading
+
+META_SUFFIX = ".meta.json"
+
+
+class ArtifactStore:
+    def __init__(self, root, max_bytes=0, max_age=0, chunk_size=64 * 1024):
+        # max_bytes / max_age(초) 가 0 이면 그 기준으로는 지우지 않는다
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name):
+        # 저장소 안의 파일 이름만 받는다 (하위 경로 / 메타데이터 / 임시 파일 제외)
+        if not name or os.path.basename(name) != name or name.startswith(".") or name.endswith((META_SUFFIX, ".tmp")):
+            return None
+        path = os.path.join(self.root, name)
+        return path if os.path.isfile(path) else None
+
+    def meta(self, name):
+        path = self.path(name)
+        if path is None:
+            return None
+        try:
+            with open(path + META_SUFFIX) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # 메타데이터 없이 남아 있던 파일
+            stat = os.stat(path)
+            return {"name": name, "size": stat.st_size, "sha256": None, "content_type": None, "created_at": stat.st_mtime}
+
+    def save_response(self, response, suffix, source=None):
+        # requests 의 stream=True 응답을 청크 단위로 임시 파일에 쓰고, 다 받은 뒤에만 제 이름으로 옮긴다
+        name = f"{uuid.uuid4()}{suffix}"
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            expected = response.headers.get("Content-Length")
+            if expected is not None and response.headers.get("Content-Encoding") is None and int(expected) != size:
+                raise IOError(f"응답이 중간에 끊겼습니다 ({size}/{expected} bytes)")
+            meta = {
+                "name": name,
+                "size": size,
+                "sha256": digest.hexdigest(),
+                "content_type": response.headers.get("Content-Type"),
+                "source": source,
+                "created_at": time.time(),
+            }
+            path = os.path.join(self.root, name)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        finally:
+            response.close()
+        with open(path + META_SUFFIX, "w") as f:
+            json.dump(meta, f)
+        self.evict(keep=(name,))
+        return meta
+
+    def evict(self, keep=()):
+        # 보관 기간이 지난 파일을 지우고, 그래도 max_bytes 를 넘으면 오래된 것부터 지운다
+        now = time.time()
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.root):
+                if not entry.is_file() or entry.name.endswith(META_SUFFIX):
+                    continue
+                stat = entry.stat()
+                if entry.name.endswith(".tmp"):
+                    # 받다가 죽은 프로세스가 남긴 임시 파일
+                    if now - stat.st_mtime > max(self.max_age, 3600):
+                        self._remove(entry.path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.name))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            removed = []
+            for mtime, size, name in entries:
+                if name in keep:
+                    continue
+                expired = self.max_age and now - mtime > self.max_age
+                if not expired and not (self.max_bytes and total > self.max_bytes):
+                    continue
+                self._remove(os.path.join(self.root, name))
+                total -= size
+                removed.append(name)
+            return removed
+
+    @staticmethod
+    def _remove(path):
+        for p in (path, path + META_SUFFIX):
+            try:
+                os.unlink(p)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,153 @@
+"""Batch generation: a JSONL manifest of songs through one warm YuEEngine.
+
+Each manifest line is one song:
+
+    {"id": "song-001", "lyrics": "...", "genre": "...", "seed": 7, "params": {"run_n_segments": 4}}
+
+`lyrics_txt` / `genre_txt` (paths, relative to the manifest) may replace the
+inline text; `id` defaults to the line number and `seed` / `params` are
+optional (params are any of yue_infer.JOB_PARAMS; manifests from the network
+may only set the numeric ones in NETWORK_PARAMS, within their limits). Songs run in groups
+through YuEEngine.generate_many, which shares stage-1 forward passes and
+stage-2 batches between the songs of a group.
+
+Every finished song is appended to the output manifest (one JSON line with
+its status, output paths and timings) and flushed to disk right away. A
+rerun with the same output manifest skips the songs already recorded as
+done, so a crashed batch resumes where it stopped; failed songs are retried.
+"""
+import os
+import re
+import json
+import time
+
+# Params a manifest from the network may set: (type, min, max). Everything else,
+# prompt file paths and output_dir included, is refused.
+NETWORK_PARAMS = {
+    "seed": (int, 0, 2**32 - 1),
+    "max_new_tokens": (int, 100, 3000),
+    "run_n_segments": (int, 1, 8),
+    "repetition_penalty": (float, 1.0, 2.0),
+    "stage2_batch_size": (int, 1, 16),
+}
+
+
+def check_network_params(params, number):
+    for key, value in params.items():
+        if key not in NETWORK_PARAMS:
+            raise ValueError(f"manifest line {number}: param '{key}' is not allowed (allowed: {', '.join(sorted(NETWORK_PARAMS))})")
+        kind, low, high = NETWORK_PARAMS[key]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or (kind is int and not float(value).is_integer()):
+            raise ValueError(f"manifest line {number}: param '{key}' must be {'an integer' if kind is int else 'a number'}")
+        if not low <= value <= high:
+            raise ValueError(f"manifest line {number}: param '{key}' must be between {low} and {high}")
+        params[key] = kind(value)
+
+
+def read_manifest(lines, base_dir="."):
+    """Parse manifest lines into records {"id", "lyrics", "genre", "params"}.
+
+    With base_dir=None (manifests from the network) `*_txt` paths are refused
+    and params are checked against NETWORK_PARAMS. Raises ValueError, with the
+    line number, for anything malformed.
+    """
+    records = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"manifest line {number}: invalid JSON ({e})") from None
+        if not isinstance(entry, dict):
+            raise ValueError(f"manifest line {number}: expected a JSON object")
+        if not isinstance(entry.get("params") or {}, dict):
+            raise ValueError(f"manifest line {number}: 'params' must be an object")
+        record = {"id": str(entry.get("id", number)), "params": dict(entry.get("params") or {})}
+        # ids name the song's output directory
+        if not re.fullmatch(r"[\w-][\w.-]*", record["id"]):
+            raise ValueError(f"manifest line {number}: id may only contain letters, digits, '_', '-' and '.'")
+        for field in ("lyrics", "genre"):
+            if field in entry:
+                if not isinstance(entry[field], str):
+                    raise ValueError(f"manifest line {number}: '{field}' must be a string")
+                record[field] = entry[field]
+            elif f"{field}_txt" in entry and base_dir is not None:
+                with open(os.path.join(base_dir, entry[f"{field}_txt"])) as f:
+                    record[field] = f.read()
+            else:
+                raise ValueError(f"manifest line {number}: '{field}' or '{field}_txt' is required")
+        if "seed" in entry:
+            try:
+                record["params"]["seed"] = int(entry["seed"])
+            except (TypeError, ValueError):
+                raise ValueError(f"manifest line {number}: 'seed' must be an integer") from None
+        if base_dir is None:
+            check_network_params(record["params"], number)
+        records.append(record)
+    ids = [record["id"] for record in records]
+    if len(set(ids)) != len(ids):
+        raise ValueError("manifest ids must be unique")
+    return records
+
+
+def load_manifest(path):
+    with open(path) as f:
+        return read_manifest(f, os.path.dirname(os.path.abspath(path)))
+
+
+def completed_ids(output_manifest):
+    """Ids recorded as done in an existing output manifest."""
+    done = set()
+    if not os.path.exists(output_manifest):
+        return done
+    with open(output_manifest) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # torn last line of a crashed run
+            if entry.get("status") == "done":
+                done.add(entry["id"])
+    return done
+
+
+def run_batch(engine, records, output_dir, output_manifest=None, group_size=4, progress=None):
+    """Generate `records` in groups of `group_size`, each song into output_dir/<id>.
+
+    `progress(record_id, stage, done, total)` is called per song. Returns a
+    summary with the done/failed/skipped counts and the throughput.
+    """
+    output_manifest = output_manifest or os.path.join(output_dir, "batch_manifest.jsonl")
+    os.makedirs(os.path.dirname(os.path.abspath(output_manifest)), exist_ok=True)
+    done = completed_ids(output_manifest)
+    pending = [record for record in records if record["id"] not in done]
+    summary = {"total": len(records), "skipped": len(records) - len(pending), "done": 0, "failed": 0}
+    start = time.perf_counter()
+    with open(output_manifest, "a") as out:
+        for first in range(0, len(pending), group_size):
+            group = pending[first:first + group_size]
+            songs = [(record["lyrics"], record["genre"], dict(record["params"], output_dir=os.path.join(output_dir, record["id"])))
+                     for record in group]
+            results = engine.generate_many(
+                songs, progress=progress and (lambda idx, stage, n, total: progress(group[idx]["id"], stage, n, total)))
+            for record, result in zip(group, results):
+                ok = result["error"] is None and result["outputs"] is not None and result["outputs"]["final_mix"] is not None
+                entry = {
+                    "id": record["id"],
+                    "status": "done" if ok else "failed",
+                    "outputs": result["outputs"],
+                    "error": result["error"] or (None if ok else "mix failed"),
+                    "seed": record["params"].get("seed", engine.args.seed),
+                    "timings": result["timings"],
+                    "finished_at": time.time(),
+                }
+                out.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                out.flush()
+                os.fsync(out.fileno())
+                summary["done" if ok else "failed"] += 1
+    summary["seconds"] = time.perf_counter() - start
+    summary["songs_per_hour"] = summary["done"] / summary["seconds"] * 3600 if summary["seconds"] else 0.0
+    summary["output_manifest"] = output_manifest
+    return summary
@@ -0,0 +1,310 @@
+"""CPU benchmark of every pipeline stage with tiny random-weight stand-in models.
+
+    python benchmarks/bench_cpu_pipeline.py [--seconds 10 30] [--batch_sizes 1 4] [--repeats 3] \
+        [--json bench.json] [--compare baseline.json --tolerance 0.15]
+
+No checkpoint download and no GPU: the stage-1 and stage-2 LMs are tiny
+randomly initialised LLaMA models with the vocabulary of the real
+mmtokenizer (so the soa/eoa, codec offset and stage-2 id ranges are the real
+ones), and the xcodec model and Vocos decoders are small convolutional
+stand-ins with the same interfaces, frame rate and samples per frame. Runs
+from the repository root, where yue_infer.py finds mm_tokenizer_v0.2_hf.
+
+For each song length and batch size it times, with fixed seeds:
+
+    stage1   the stage-1 segment loop (CFG, framing, KV carry-over), batch_size songs at once
+    stage2   stage2_inference over batch_size songs' stage-1 tracks, stage2_batch_size = batch_size
+    repair   fix_invalid_codes on a track of stage-2 codes with 1% invalid codes
+    decode   streaming codec reconstruction and vocoder decode of one song
+    mix      limiter and low-band replacement of one song
+
+and reports the median latency, the throughput (audio seconds per second)
+and the peak RSS seen while the stage ran. The absolute numbers say little
+about the real models; changes between commits of the code around them are
+what it measures. With --compare it exits with status 1 if any case got
+slower than the baseline report by more than --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+import numpy as np
+import torch
+from torch import nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import yue_infer
+import yue_engine
+from yue_engine import YuEEngine, fix_invalid_codes
+from streaming_decode import CODEC_FRAME_RATE
+
+STAGES = ("stage1", "stage2", "repair", "decode", "mix")
+
+
+class TinyCodec(nn.Module):
+    """Stand-in for xcodec's SoundStream: 16 kHz audio, 320 samples per frame, 8 codebooks of 1024."""
+
+    def __init__(self, n_codebooks=8, codebook_size=1024, dim=64, hop=320):
+        super().__init__()
+        self.n_codebooks = n_codebooks
+        self.codebook_size = codebook_size
+        self.encoder = nn.Conv1d(1, dim, hop, stride=hop)
+        self.project = nn.Conv1d(dim, n_codebooks * codebook_size, 1)
+        self.codebooks = nn.Embedding(n_codebooks * codebook_size, dim)
+        self.decoder = nn.Sequential(nn.Conv1d(dim, dim, 3, padding=1), nn.GELU(), nn.ConvTranspose1d(dim, 1, hop, stride=hop))
+
+    def encode(self, x, target_bw=0.5):
+        # (batch, 1, samples) -> (n_codebooks used, batch, frames); 0.5 kbps is one codebook
+        n = max(1, min(self.n_codebooks, int(target_bw * 2)))
+        logits = self.project(self.encoder(x)).unflatten(1, (self.n_codebooks, self.codebook_size))
+        return logits.argmax(2)[:, :n].transpose(0, 1)
+
+    def get_embed(self, codes):
+        # (n_codebooks, batch, frames) -> (batch, dim, frames)
+        offsets = torch.arange(codes.shape[0], device=codes.device).view(-1, 1, 1) * self.codebook_size
+        return self.codebooks(codes + offsets).sum(0).transpose(1, 2)
+
+    def decode(self, codes):
+        return self.decoder(self.get_embed(codes))
+
+
+class TinyVocoder(nn.Module):
+    """Stand-in for a Vocos decoder: codec embeddings in, 44.1 kHz audio (882 samples per frame) out."""
+
+    def __init__(self, dim=64, hop=882):
+        super().__init__()
+        self.net = nn.Sequential(nn.Conv1d(dim, dim, 7, padding=3), nn.GELU(), nn.ConvTranspose1d(dim, 1, hop, stride=hop))
+
+    def forward(self, embed):
+        return torch.tanh(self.net(embed))
+
+
+class TinyEngine(YuEEngine):
+    def _load_codec(self):
+        torch.manual_seed(self.args.seed)
+        return TinyCodec()
+
+    def _load_vocoders(self):
+        torch.manual_seed(self.args.seed + 1)
+        return TinyVocoder(), TinyVocoder()
+
+
+def save_tiny_lm(path, vocab_size, seed, codec_range=None, eoa_id=None, hidden_size=64, layers=2):
+    from transformers import LlamaConfig, LlamaForCausalLM
+    torch.manual_seed(seed)
+    config = LlamaConfig(vocab_size=vocab_size, hidden_size=hidden_size, intermediate_size=hidden_size * 2,
+                         num_hidden_layers=layers, num_attention_heads=4, num_key_value_heads=2,
+                         max_position_embeddings=16384)
+    model = LlamaForCausalLM(config)
+    if eoa_id is not None:
+        # sharp codec logits next to a zero eoa logit: segments run to max_new_tokens,
+        # so every run samples the requested song length
+        with torch.no_grad():
+            model.lm_head.weight[codec_range[0]:codec_range[1]] *= 50
+            model.lm_head.weight[eoa_id] = 0
+    model.save_pretrained(path)
+
+
+class PeakRss:
+    """Highest resident set size while the block runs, sampled every few milliseconds."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    @staticmethod
+    def current():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def lyrics_for(n_segments):
+    return "".join(f"[{'verse' if i % 2 else 'chorus'}]\nline {i} of the benchmark song\n\n" for i in range(n_segments + 1))
+
+
+def run_stage1(engine, seconds, batch_size, seed):
+    # two segments per song of 2 tokens (vocal + instrumental) per frame; the songs share the batcher
+    results = [None] * batch_size
+
+    def song(idx):
+        job = engine.job_args({"run_n_segments": 2, "max_new_tokens": seconds * CODEC_FRAME_RATE, "seed": seed + idx})
+        results[idx] = engine.stage1_inference(job, lyrics_for(2), "pop")
+    threads = [threading.Thread(target=song, args=(idx,)) for idx in range(batch_size)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(tracks[0].shape[-1] for tracks in results) / CODEC_FRAME_RATE
+
+
+def stage1_tracks(rng, seconds):
+    return [rng.integers(0, 1024, size=(1, seconds * CODEC_FRAME_RATE)) for _ in range(2)]
+
+
+def run_case(engine, stage, seconds, batch_size, seed):
+    """Runs one case; returns the seconds of audio it processed."""
+    rng = np.random.default_rng(seed)
+    if stage == "stage1":
+        return run_stage1(engine, seconds, batch_size, seed)
+    if stage == "stage2":
+        tracks = [track for _ in range(batch_size) for track in stage1_tracks(rng, seconds)]
+        engine.stage2_inference(engine.model_stage2, tracks, batch_size=batch_size)
+        return batch_size * seconds
+    if stage == "repair":
+        for _ in range(batch_size):
+            codes = rng.integers(0, 1024, size=(8, seconds * CODEC_FRAME_RATE))
+            invalid = rng.random(codes.shape) < 0.01
+            codes[invalid] = rng.integers(-2048, -1, size=invalid.sum())
+            fix_invalid_codes(codes)
+        return batch_size * seconds
+    job = engine.job_args()
+    codes = [rng.integers(0, 1024, size=(8, seconds * CODEC_FRAME_RATE)) for _ in range(2)]
+    decoder = engine.song_decoder(job, [track.shape[-1] for track in codes])
+    for start in range(0, seconds * CODEC_FRAME_RATE, yue_infer.STAGE2_CHUNK_FRAMES):
+        for n, track in enumerate(codes):
+            decoder.push(n, track[:, start:start + yue_infer.STAGE2_CHUNK_FRAMES])
+    audio = decoder.finish()
+    if stage == "decode":
+        return seconds
+    start = time.perf_counter()
+    engine.mix(job, audio)
+    # only the mix itself is timed; the caller subtracts the decode
+    return seconds, time.perf_counter() - start
+
+
+def measure(engine, stage, seconds, batch_size, repeats, seed):
+    latencies, audio_seconds = [], 0.0
+    with PeakRss() as rss:
+        for repeat in range(repeats):
+            start = time.perf_counter()
+            result = run_case(engine, stage, seconds, batch_size, seed)
+            elapsed = time.perf_counter() - start
+            if isinstance(result, tuple):
+                result, elapsed = result
+            latencies.append(elapsed)
+            audio_seconds = result
+    latency = float(np.median(latencies))
+    return {
+        "stage": stage,
+        "seconds": seconds,
+        "batch_size": batch_size,
+        "latency_s": latency,
+        "latencies_s": latencies,
+        "audio_seconds": audio_seconds,
+        "throughput": audio_seconds / latency if latency else None,
+        "peak_rss_mb": rss.peak / 1024**2,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(report, baseline, tolerance):
+    """Print the latency change of every case found in both reports; returns the regressed ones."""
+    old = {(r["stage"], r["seconds"], r["batch_size"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"\ncompared with {baseline['meta'].get('commit')}:")
+    for r in report["results"]:
+        key = (r["stage"], r["seconds"], r["batch_size"])
+        if key not in old:
+            continue
+        change = r["latency_s"] / old[key]["latency_s"] - 1 if old[key]["latency_s"] else 0.0
+        flag = "REGRESSION" if change > tolerance else ""
+        if flag:
+            regressions.append(key)
+        print(f"{key[0]:<7} {key[1]:>5} s x{key[2]:<3} {old[key]['latency_s']:>9.4f} -> {r['latency_s']:>9.4f} s {change:>+7.1%} {flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--seconds", type=int, nargs="+", default=[10, 30], help="Song lengths in seconds.")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4], help="Songs per stage-1 batch / stage-2 batch size.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per case; the median latency is reported.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=0, help="torch CPU threads; 0 keeps torch's default.")
+    parser.add_argument("--json", type=str, default="", help="Write the report to this file as JSON.")
+    parser.add_argument("--compare", type=str, default="", help="Baseline report (--json of an earlier run) to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Latency increase over the baseline counted as a regression.")
+    bench = parser.parse_args()
+
+    tokenizer = yue_engine._MMSentencePieceTokenizer("./mm_tokenizer_v0.2_hf/tokenizer.model")
+    vocab_size = tokenizer.vocab_size
+    codec_start = yue_engine.CodecManipulator("xcodec", 0, 1).global_offset
+    with tempfile.TemporaryDirectory() as tmp:
+        save_tiny_lm(os.path.join(tmp, "stage1"), vocab_size, bench.seed,
+                     codec_range=(codec_start, codec_start + 1024), eoa_id=tokenizer.eoa)
+        save_tiny_lm(os.path.join(tmp, "stage2"), vocab_size, bench.seed + 1)
+        args = yue_infer.default_args(
+            stage1_model=os.path.join(tmp, "stage1"), stage2_model=os.path.join(tmp, "stage2"),
+            device="cpu", stage1_batch_size=max(bench.batch_sizes), disable_int8=True,
+            cpu_threads=bench.threads, compile_cache_dir="", seed=bench.seed,
+        )
+        engine = TinyEngine(args)
+        results = []
+        for stage in bench.stages:
+            for seconds in bench.seconds:
+                for batch_size in bench.batch_sizes if stage in ("stage1", "stage2", "repair") else [1]:
+                    result = measure(engine, stage, seconds, batch_size, bench.repeats, bench.seed)
+                    results.append(result)
+                    print(f"{stage:<7} {seconds:>5} s x{batch_size:<3} {result['latency_s']:>9.4f} s "
+                          f"{result['throughput']:>9.2f} audio s/s {result['peak_rss_mb']:>8.0f} MB")
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "threads": torch.get_num_threads(),
+            "seed": bench.seed,
+            "repeats": bench.repeats,
+            "vocab_size": vocab_size,
+        },
+        "results": results,
+    }
+    if bench.json:
+        with open(bench.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if bench.compare:
+        with open(bench.compare) as f:
+            regressions = compare(report, json.load(f), bench.tolerance)
+        if regressions:
+            print(f"{len(regressions)} case(s) slower than the baseline by more than {bench.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
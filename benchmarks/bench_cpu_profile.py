@@ -0,0 +1,153 @@
+"""Quality-vs-speed report of the CPU profile against the bf16 GPU baseline.
+
+    python benchmarks/bench_cpu_profile.py --vtrack stage1/..._vtrack.npy --itrack stage1/..._itrack.npy \
+        [--profiles cuda-bf16 cpu-int8 cpu-fp32] [--json cpu_profile.json] [engine args...]
+    python benchmarks/bench_cpu_profile.py --tiny [--seconds 30] [--profiles cpu-fp32 cpu-int8]
+
+Runs stage 2 and the codec/vocoder decode of one song's stage-1 tokens (as
+written with --keep_intermediate) under each profile, each with a fresh
+engine that does not load the stage-1 model. For every profile it reports
+the stage-2 and decode wall time and their real-time factor (seconds per
+second of audio); for every profile after the first, how far it is from the
+first one: the share of identical stage-2 codes per codebook, and the SNR
+and log-spectral distance of the vocoder mix.
+
+With --tiny the stage-2 LM, codec and decoders are the random-weight
+stand-ins of bench_cpu_pipeline.py and the stage-1 tracks are random codes
+of --seconds seconds: no checkpoint download, so the harness itself can be
+checked anywhere, but the numbers say nothing about the real models.
+"""
+import os
+import gc
+import sys
+import json
+import time
+import tempfile
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import yue_infer
+
+PROFILES = {
+    "cuda-bf16": {"stage2_device": "cuda"},
+    "cpu-int8": {"stage2_device": "cpu", "disable_int8": False},
+    "cpu-fp32": {"stage2_device": "cpu", "disable_int8": True},
+}
+
+
+def snr_db(reference, estimate):
+    n = min(reference.shape[-1], estimate.shape[-1])
+    reference, estimate = reference[..., :n].double(), estimate[..., :n].double()
+    noise = (reference - estimate).pow(2).sum()
+    return float(10 * torch.log10(reference.pow(2).sum() / noise.clamp(min=1e-20)))
+
+
+def log_spectral_distance(reference, estimate, n_fft=2048, eps=1e-10):
+    """Mean over frames of the RMS difference of the log power spectra, in dB."""
+    n = min(reference.shape[-1], estimate.shape[-1])
+    window = torch.hann_window(n_fft, dtype=torch.float64)
+
+    def log_power(wav):
+        spec = torch.stft(wav[..., :n].double().reshape(-1), n_fft, window=window, return_complex=True)
+        return 10 * torch.log10(spec.abs().pow(2) + eps)
+    diff = log_power(reference) - log_power(estimate)
+    return float(diff.pow(2).mean(dim=0).sqrt().mean())
+
+
+def run_profile(bench_args, overrides, stage1_tracks, engine_class=None):
+    args = yue_infer.default_args(**dict(bench_args, **overrides))
+    if engine_class is None:
+        from yue_engine import YuEEngine as engine_class
+    engine = engine_class(args)
+    job = engine.job_args()
+    with engine.residency.use(*yue_infer.STAGE2_MODELS):
+        start = time.perf_counter()
+        stage2_tracks = engine.stage2_inference(engine.model_stage2, stage1_tracks, batch_size=job.stage2_batch_size)
+        stage2_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        decoder = engine.song_decoder(job, [track.shape[-1] for track in stage2_tracks])
+        for n, track in enumerate(stage2_tracks):
+            decoder.push(n, track)
+        audio = engine.mix(job, decoder.finish())
+        decode_seconds = time.perf_counter() - start
+    result = {
+        "stage2_seconds": stage2_seconds,
+        "decode_seconds": decode_seconds,
+        "load_seconds": sum(engine.startup_timings.values()),
+    }
+    del engine
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return result, stage2_tracks, audio["vocoder_mix"]
+
+
+def main():
+    parser = yue_infer.build_parser()
+    parser.add_argument("--vtrack", type=str, default="", help="Stage-1 vocal track (.npy).")
+    parser.add_argument("--itrack", type=str, default="", help="Stage-1 instrumental track (.npy).")
+    parser.add_argument("--tiny", action="store_true", help="Use tiny random-weight stand-in models and random stage-1 tracks.")
+    parser.add_argument("--seconds", type=int, default=30, help="Length of the random stage-1 tracks with --tiny.")
+    parser.add_argument("--profiles", nargs="+", choices=list(PROFILES),
+                        default=["cuda-bf16", "cpu-int8"] if torch.cuda.is_available() else ["cpu-fp32", "cpu-int8"],
+                        help="Profiles to run; the first one is the reference.")
+    parser.add_argument("--json", type=str, default="", help="Write the report to this file as JSON.")
+    args = parser.parse_args()
+    if args.tiny:
+        rng = np.random.default_rng(args.seed)
+        stage1_tracks = [rng.integers(0, 1024, size=(1, args.seconds * 50)) for _ in range(2)]
+    elif args.vtrack and args.itrack:
+        stage1_tracks = [np.load(args.vtrack), np.load(args.itrack)]
+    else:
+        parser.error("--vtrack and --itrack are required without --tiny")
+    audio_seconds = min(track.shape[-1] for track in stage1_tracks) / 50
+    bench_args = {k: v for k, v in vars(args).items() if k not in ("vtrack", "itrack", "tiny", "seconds", "profiles", "json")}
+    # decode-only engines: the stage-1 model is not loaded, but it still names the cache entries
+    bench_args["stage1_model_id"] = args.stage1_model_id or args.stage1_model
+    bench_args["stage1_model"] = ""
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine_class = None
+        if args.tiny:
+            from bench_cpu_pipeline import TinyEngine, save_tiny_lm
+            import yue_engine
+            vocab_size = yue_engine._MMSentencePieceTokenizer("./mm_tokenizer_v0.2_hf/tokenizer.model").vocab_size
+            save_tiny_lm(os.path.join(tmp, "stage2"), vocab_size, args.seed + 1)
+            bench_args.update(stage2_model=os.path.join(tmp, "stage2"), compile_cache_dir="")
+            engine_class = TinyEngine
+        report = run_profiles(args, bench_args, stage1_tracks, audio_seconds, engine_class)
+
+    print(f"{audio_seconds:.1f} s of audio, reference {args.profiles[0]}{' (tiny stand-in models)' if args.tiny else ''}")
+    print(f"{'profile':<10} {'stage2 s':>9} {'decode s':>9} {'RTF':>6} {'codes eq':>9} {'SNR dB':>7} {'LSD dB':>7}")
+    for name, r in report["profiles"].items():
+        agreement = f"{np.mean(r['code_agreement']):.3f}" if "code_agreement" in r else "-"
+        snr = f"{r['snr_db']:.1f}" if "snr_db" in r else "-"
+        lsd = f"{r['lsd_db']:.2f}" if "lsd_db" in r else "-"
+        print(f"{name:<10} {r['stage2_seconds']:>9.1f} {r['decode_seconds']:>9.1f} {r['rtf']:>6.2f} {agreement:>9} {snr:>7} {lsd:>7}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def run_profiles(args, bench_args, stage1_tracks, audio_seconds, engine_class=None):
+    report = {"audio_seconds": audio_seconds, "reference": args.profiles[0], "tiny": args.tiny, "profiles": {}}
+    reference = None
+    for name in args.profiles:
+        result, codes, mix = run_profile(bench_args, PROFILES[name], stage1_tracks, engine_class)
+        result["rtf"] = (result["stage2_seconds"] + result["decode_seconds"]) / audio_seconds
+        if reference is None:
+            reference = codes, mix
+        else:
+            result["code_agreement"] = np.mean([(a[:, :b.shape[-1]] == b[:, :a.shape[-1]]).mean(axis=1)
+                                                for a, b in zip(reference[0], codes)], axis=0).round(4).tolist()
+            if reference[1] is not None and mix is not None:
+                result["snr_db"] = snr_db(reference[1], mix)
+                result["lsd_db"] = log_spectral_distance(reference[1], mix)
+        report["profiles"][name] = result
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Micro-benchmark: stage-2 invalid-code repair, original loop vs fix_invalid_codes.
+
+    python benchmarks/bench_stage2_repair.py --seconds 180 --invalid_ratio 0.001 0.01 0.1
+
+Checks that both produce byte-identical .npy output and prints the timings.
+"""
+import os
+import io
+import sys
+import copy
+import time
+import argparse
+from collections import Counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from yue_engine import fix_invalid_codes
+
+
+def legacy_fix(output):
+    # The loop stage2_inference used before fix_invalid_codes
+    fixed_output = copy.deepcopy(output)
+    for i, line in enumerate(output):
+        for j, element in enumerate(line):
+            if element < 0 or element > 1023:
+                counter = Counter(line)
+                most_frequant = sorted(counter.items(), key=lambda x: x[1], reverse=True)[0][0]
+                fixed_output[i, j] = most_frequant
+    return fixed_output
+
+
+def make_codes(rng, seconds, invalid_ratio, n_codebooks=8):
+    # stage-2 output after ids2npy: (codebooks, 50 frames/s), mostly valid codes
+    codes = rng.integers(0, 1024, size=(n_codebooks, seconds * 50))
+    invalid = rng.random(codes.shape) < invalid_ratio
+    codes[invalid] = rng.integers(-2048, -1, size=invalid.sum())
+    return codes
+
+
+def npy_bytes(array):
+    buf = io.BytesIO()
+    np.save(buf, array)
+    return buf.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=int, default=180)
+    parser.add_argument("--invalid_ratio", type=float, nargs="+", default=[0.0, 0.001, 0.01, 0.05])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'invalid':>8} {'legacy (s)':>11} {'vectorized (s)':>15} {'speedup':>8}")
+    for ratio in args.invalid_ratio:
+        codes = make_codes(rng, args.seconds, ratio)
+
+        start = time.perf_counter()
+        expected = legacy_fix(codes)
+        legacy_time = time.perf_counter() - start
+
+        fixed = codes.copy()
+        start = time.perf_counter()
+        fix_invalid_codes(fixed)
+        fast_time = time.perf_counter() - start
+
+        assert npy_bytes(expected) == npy_bytes(fixed), f"outputs differ at invalid_ratio={ratio}"
+        print(f"{ratio:>8} {legacy_time:>11.4f} {fast_time:>15.6f} {legacy_time / max(fast_time, 1e-9):>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Startup benchmark: how long until a YuEEngine can serve, phase by phase.
+
+    python benchmarks/bench_startup.py --compile_cache_dir ./compile_cache [--warmup] [--json startup.json] [engine args...]
+
+Reports the import of the CLI module, the import of the engine (torch,
+transformers, codec), every weight-loading phase and, with --warmup, the
+first compiled forward passes. Run it twice: the second run shows what a
+restarted worker pays once the compile cache is warm.
+"""
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    timings = {}
+    start = time.perf_counter()
+    import yue_infer
+    timings["import_cli"] = time.perf_counter() - start
+
+    parser = yue_infer.build_parser()
+    parser.add_argument("--warmup", action="store_true", help="Also time the first (compiled) forward passes.")
+    parser.add_argument("--json", type=str, default="", help="Write the timings to this file as JSON.")
+    args = parser.parse_args()
+
+    phase_start = time.perf_counter()
+    import yue_engine
+    timings["import_engine"] = time.perf_counter() - phase_start
+
+    engine = yue_engine.YuEEngine(args)
+    timings.update(engine.startup_timings)
+    if args.warmup:
+        engine.warmup()
+        timings.update((name, engine.startup_timings[name]) for name in ("stage1_warmup", "stage2_warmup")
+                        if name in engine.startup_timings)
+    timings["total"] = time.perf_counter() - start
+
+    print(f"{'phase':<18} {'seconds':>8}")
+    for name, seconds in timings.items():
+        print(f"{name:<18} {seconds:>8.2f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(timings, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import os
+import time
+import shutil
+import tempfile
+
+import torch
+
+
+class JobCheckpoint:
+    """Partial progress of one song, saved under its stable stage keys.
+
+    Each pipeline level has its own directory, named after the result-cache
+    key of that level (see YuEEngine.cache_keys): stage-1 progress under the
+    stage-1 key, stage-2 chunks under the stage-2 key, decoded audio under the
+    final key. A rerun of the same song therefore finds the progress of an
+    interrupted run, and songs that only differ in later settings share the
+    earlier levels. Units are written atomically, so a crash never leaves a
+    torn file, and only read back when `resume` is set.
+    """
+
+    LEVELS = ("stage1", "stage2", "final")
+
+    def __init__(self, root, keys, resume=True):
+        self.keys = tuple(keys[level] for level in self.LEVELS)
+        self.dirs = {level: os.path.join(root, keys[level]) for level in self.LEVELS}
+        self.resume = resume
+
+    def _path(self, level, name):
+        return os.path.join(self.dirs[level], f"{name}.pt")
+
+    def load(self, level, name):
+        """The saved unit, or None."""
+        if not self.resume:
+            return None
+        try:
+            return torch.load(self._path(level, name), map_location="cpu", weights_only=False)
+        except FileNotFoundError:
+            return None
+
+    def save(self, level, name, obj):
+        os.makedirs(self.dirs[level], exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.dirs[level], suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                torch.save(obj, f)
+            os.replace(tmp, self._path(level, name))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def clear(self):
+        """Drop all progress of the song once its outputs are written."""
+        for path in self.dirs.values():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def prune_checkpoints(root, max_bytes=0, max_age=0, keep=()):
+    """Remove the progress of songs that failed or were abandoned.
+
+    Level directories not written to for `max_age` seconds are removed, then
+    the least recently written ones while the total is above `max_bytes`
+    (0 disables either limit). Directories named in `keep`, the keys of the
+    songs still running, are left alone. Returns the names removed.
+    """
+    if not (max_bytes or max_age) or not os.path.isdir(root):
+        return []
+    now = time.time()
+    entries = []
+    total = 0
+    for entry in os.scandir(root):
+        if not entry.is_dir():
+            continue
+        try:
+            size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+            mtime = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue    # cleared by its song meanwhile
+        # songs still running count towards the size, but are not removed
+        total += size
+        if entry.name not in keep:
+            entries.append((mtime, size, entry.name))
+    entries.sort()
+    removed = []
+    for mtime, size, name in entries:
+        if not (max_age and now - mtime > max_age) and not (max_bytes and total > max_bytes):
+            break
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+        total -= size
+        removed.append(name)
+    return removed
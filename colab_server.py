@@ -1,58 +1,359 @@
 # colab_server.py
 import os
-import subprocess
-from flask import Flask, request, send_file, jsonify
+import re
+import json
+import queue
+import struct
+import shutil
+import tempfile
+import threading
+from flask import Flask, Response, request, send_file, jsonify, stream_with_context
 from flask_cors import CORS
 from pyngrok import ngrok
+from job_queue import JobQueue, DONE, RUNNING
+import batch_runner
+import metrics
 
 app = Flask(__name__)
 CORS(app)
 
-def yue_generate(lyrics, genre, output_dir="./output"):
-    # 1) 입력 임시 저장
-    with open("lyrics.txt", "w", encoding="utf-8") as f:
-        f.write(lyrics)
-    with open("genre.txt", "w", encoding="utf-8") as f:
-        f.write(genre)
-    # 2) yue_infer.py 실행
-    cmd = [
-        "python", "yue_infer.py",
-        "--lyrics_txt", "lyrics.txt",
-        "--genre_txt", "genre.txt",
-        "--output_dir", output_dir
-    ]
-    proc = subprocess.run(cmd, capture_output=True, text=True)
-    print(proc.stdout, proc.stderr)
-
-    # 3) 믹스된 mp3 경로 찾기
-    mp3_dir = os.path.join(output_dir, "vocoder", "mix")
-    for fn in os.listdir(mp3_dir):
-        if fn.endswith(".mp3"):
-            return os.path.join(mp3_dir, fn)
-    return None
+# 동시에 GPU 를 쓰는 워커 수 / 대기열 최대 길이
+YUE_WORKERS    = int(os.getenv("YUE_WORKERS", "1"))
+YUE_MAX_QUEUED = int(os.getenv("YUE_MAX_QUEUED", "32"))
 
+# 끝난 job 을 메모리에 들고 있는 시간(초) / 개수. 그 뒤로는 상태 조회가 404 지만
+# 결과물은 /artifacts 로 계속 받을 수 있고, 같은 요청을 다시 보내면 결과 캐시에서 바로 끝난다
+YUE_JOB_TTL           = float(os.getenv("YUE_JOB_TTL", "3600"))
+YUE_MAX_FINISHED_JOBS = int(os.getenv("YUE_MAX_FINISHED_JOBS", "256"))
+
+# job 별 작업 폴더(끝나면 삭제) / job id 별 결과물 폴더
+SCRATCH_DIR = os.getenv("YUE_SCRATCH_DIR", "./scratch")
+RESULTS_DIR = os.getenv("YUE_RESULTS_DIR", "./results")
+os.makedirs(SCRATCH_DIR, exist_ok=True)
+os.makedirs(RESULTS_DIR, exist_ok=True)
+
+ARTIFACT_NAMES = {"mp3": "song.mp3", "pdf": "score.pdf", "manifest": "batch_manifest.jsonl", "timings": "timings.json"}
+
+# 배치(JSONL 매니페스트) 생성: 한 번에 같이 돌리는 곡 수 / 대기 중인 배치 최대 개수
+YUE_BATCH_GROUP_SIZE = int(os.getenv("YUE_BATCH_GROUP_SIZE", "4"))
+YUE_MAX_BATCHES      = int(os.getenv("YUE_MAX_BATCHES", "4"))
+
+# 생성 중 미리듣기 스트림 (보코더 믹스, 16bit mono WAV)
+STREAM_SAMPLE_RATE = 44100
+
+# 같은 가사/장르/시드/파라미터 결과 캐시 (빈 값이면 사용 안 함)
+YUE_CACHE_DIR    = os.getenv("YUE_CACHE_DIR", "./cache")
+YUE_CACHE_MAX_GB = float(os.getenv("YUE_CACHE_MAX_GB", "20"))
+
+# 곡마다 끝난 stage1 구간·stage2 청크·디코딩된 스템을 저장해 둔다 (빈 값이면 사용 안 함).
+# 서버가 중간에 죽어도 같은 요청을 다시 보내면 마지막으로 저장된 단위부터 이어서 생성
+YUE_CHECKPOINT_DIR = os.getenv("YUE_CHECKPOINT_DIR", "./checkpoints")
+# 실패했거나 버려진 곡의 체크포인트는 곡이 시작될 때마다 정리한다: 이 시간(시간) 동안 안 쓰인 것,
+# 그리고 전체 크기(GB)를 넘으면 가장 오래 안 쓰인 것부터. 0 이면 제한 없음
+YUE_CHECKPOINT_MAX_AGE_HOURS = float(os.getenv("YUE_CHECKPOINT_MAX_AGE_HOURS", "24"))
+YUE_CHECKPOINT_MAX_GB        = float(os.getenv("YUE_CHECKPOINT_MAX_GB", "10"))
+
+# 모델을 돌릴 장치: auto / cuda / cpu. YUE_STAGE2_DEVICE=cpu 면 stage2·코덱·보코더는 CPU(int8) 에서,
+# GPU 는 stage1 만 돌린다. CPU 스레드는 기본적으로 코어를 워커 수로 나눠 쓴다
+YUE_DEVICE        = os.getenv("YUE_DEVICE", "auto")
+YUE_STAGE2_DEVICE = os.getenv("YUE_STAGE2_DEVICE", "")
+YUE_CPU_THREADS   = int(os.getenv("YUE_CPU_THREADS", str(max(1, (os.cpu_count() or 1) // YUE_WORKERS))))
+
+# 1 이면 stage1 구간이 하나 끝날 때마다 바로 stage2·보코더로 넘겨서 세 단계를 겹쳐 돌린다.
+# 미리듣기가 훨씬 빨리 시작되지만 stage1·stage2 모델이 동시에 장치에 올라가 있어야 한다
+YUE_PIPELINE_STAGES = os.getenv("YUE_PIPELINE_STAGES", "0") == "1"
+
+# YuE 모델은 서버 프로세스당 한 번만 로드해서 계속 메모리에 올려둔다
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            from yue_infer import default_args
+            from yue_engine import YuEEngine
+            # 워커들(또는 배치 한 그룹)이 동시에 돌리는 곡들의 stage1 구간은 한 배치로 묶어서 생성
+            _engine = YuEEngine(default_args(cache_dir=YUE_CACHE_DIR, cache_max_gb=YUE_CACHE_MAX_GB,
+                                             stage1_batch_size=max(YUE_WORKERS, YUE_BATCH_GROUP_SIZE), device=YUE_DEVICE,
+                                             stage2_device=YUE_STAGE2_DEVICE, cpu_threads=YUE_CPU_THREADS,
+                                             checkpoint_dir=YUE_CHECKPOINT_DIR, resume=True,
+                                             checkpoint_max_age_hours=YUE_CHECKPOINT_MAX_AGE_HOURS,
+                                             checkpoint_max_gb=YUE_CHECKPOINT_MAX_GB,
+                                             pipeline_stages=YUE_PIPELINE_STAGES))
+    return _engine
+
+def wav_header(sample_rate, channels=1, bits=16):
+    # 길이를 모르는 스트리밍 WAV: RIFF / data 크기는 최대값으로 채운다
+    block_align = channels * bits // 8
+    return (b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, sample_rate, sample_rate * block_align, block_align, bits)
+            + b"data" + struct.pack("<I", 0xFFFFFFFF))
+
+def pcm16(wav):
+    # (1, samples) float 텐서 -> little-endian 16bit PCM
+    return (wav.reshape(-1).clamp(-1, 1) * 32767).short().numpy().tobytes()
+
+def yue_generate(lyrics, genre, output_dir, params=None, progress=None, audio=None):
+    # 1) 이미 로드된 엔진으로 바로 추론 (subprocess / 모델 재로딩 없음)
+    #    audio(ByteStream) 가 있으면 stage2 가 진행되는 동안 디코딩된 오디오를 바로 써 넣는다
+    audio_sink = (lambda wav: audio.write(pcm16(wav))) if audio is not None else None
+    outputs = get_engine().generate(lyrics, genre, dict(params or {}, output_dir=output_dir),
+                                    progress=progress, audio_sink=audio_sink)
+    # 2) 한 번의 실행에서 나온 결과물을 모두 모은다
+    artifacts = {}
+    if outputs["vocoder_mix"]:
+        artifacts["mp3"] = outputs["vocoder_mix"]
+    pdf_path = os.path.join(output_dir, "score.pdf")  # yue_infer.py에서 PDF 생성 경로에 맞춰 조정
+    if os.path.exists(pdf_path):
+        artifacts["pdf"] = pdf_path
+    # 단계별 소요 시간 / 토큰 속도 / 최대 메모리
+    if os.path.exists(outputs["timings"]):
+        artifacts["timings"] = outputs["timings"]
+    return artifacts
+
+def run_job(job):
+    # job 마다 별도의 작업 폴더에서 생성 -> 동시에 돌아도 입력/출력이 섞이지 않는다
+    scratch_dir = tempfile.mkdtemp(prefix=f"{job.id}-", dir=SCRATCH_DIR)
+    metrics.REGISTRY.observe("queue_wait_seconds", job.started_at - job.created_at, queue="song")
+    try:
+        artifacts = yue_generate(job.lyrics, job.genre, scratch_dir, job.params, progress=job.on_progress, audio=job.audio)
+        if "mp3" not in artifacts:
+            raise RuntimeError('MP3 파일 생성 실패')
+        # 결과물만 job id 폴더로 옮기고 중간 산출물은 지운다
+        job_dir = os.path.join(RESULTS_DIR, job.id)
+        os.makedirs(job_dir, exist_ok=True)
+        results = {}
+        for name, path in artifacts.items():
+            results[name] = os.path.join(job_dir, ARTIFACT_NAMES[name])
+            shutil.move(path, results[name])
+        return results
+    finally:
+        # 이미 듣고 있던 구독자는 끝까지 읽고, 이후 요청은 완성된 mp3 로 응답한다
+        job.audio.close()
+        job.audio = None
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+def cached_job(job):
+    # 캐시에 최종 결과가 있으면 큐에 넣지 않고 바로 결과물 폴더로 복사
+    cached = get_engine().cached_outputs(job.lyrics, job.genre, job.params)
+    if cached is None:
+        return None
+    job_dir = os.path.join(RESULTS_DIR, job.id)
+    os.makedirs(job_dir, exist_ok=True)
+    mp3_path = os.path.join(job_dir, ARTIFACT_NAMES["mp3"])
+    try:
+        shutil.copyfile(cached["vocoder_mix"], mp3_path)
+    except FileNotFoundError:
+        # 그 사이에 캐시에서 밀려났으면 평소처럼 생성
+        return None
+    return {"mp3": mp3_path}
+
+# 미리듣기 스트림은 큐에 넣을 때 만들어 두고 run_job 이 닫는다
+jobs = JobQueue(run_job, workers=YUE_WORKERS, max_queued=YUE_MAX_QUEUED, fast_path=cached_job,
+                finished_ttl=YUE_JOB_TTL, max_finished=YUE_MAX_FINISHED_JOBS, audio_streams=True)
+
+def run_batch_job(job):
+    # 곡들은 RESULTS_DIR/<배치 id>/<곡 id>/ 에 생성되고, 끝난 곡마다 매니페스트에 한 줄씩 남는다
+    # (서버가 죽었다 살아나도 같은 매니페스트로 다시 돌리면 끝난 곡은 건너뛴다)
+    records = job.params["records"]
+    metrics.REGISTRY.observe("queue_wait_seconds", job.started_at - job.created_at, queue="batch")
+    job_dir = os.path.join(RESULTS_DIR, job.id)
+    manifest = os.path.join(job_dir, ARTIFACT_NAMES["manifest"])
+
+    def progress(record_id, stage, done, total):
+        job.emit("progress", {"id": record_id, "stage": stage, "done": done, "total": total})
+    for first in range(0, len(records), YUE_BATCH_GROUP_SIZE):
+        batch_runner.run_batch(get_engine(), records[first:first + YUE_BATCH_GROUP_SIZE], job_dir, manifest,
+                               group_size=YUE_BATCH_GROUP_SIZE, progress=progress)
+        finished = batch_runner.completed_ids(manifest)
+        job.on_progress("songs", len(finished), len(records))
+    return {"manifest": manifest}
+
+# 배치는 곡 job 과 같은 엔진을 쓰지만 따로 줄을 선다 (한 번에 한 배치)
+batch_jobs = JobQueue(run_batch_job, workers=1, max_queued=YUE_MAX_BATCHES,
+                      finished_ttl=YUE_JOB_TTL, max_finished=YUE_MAX_FINISHED_JOBS)
+
+def batch_songs(job_id):
+    # 매니페스트에 기록된 곡별 결과 (마지막 기록이 우선)
+    manifest = os.path.join(RESULTS_DIR, job_id, ARTIFACT_NAMES["manifest"])
+    songs = {}
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                songs[entry["id"]] = entry
+    return songs
+
+def job_response(job):
+    data = job.to_dict()
+    data["events_url"] = f"/jobs/{job.id}/events"
+    if job.status == DONE:
+        # mp3/pdf 모두 같은 샘플에서 나온 결과물 -> job 단위 URL로 돌려준다
+        data["artifacts"] = {name: f"/artifacts/{job.id}/{name}" for name in job.artifacts}
+    return data
+
+# 1) job 등록: id 만 바로 돌려주고 생성은 워커가 처리
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    lyrics = request.form.get('lyrics', '')
+    genre  = request.form.get('genre', 'pop')
+    if not lyrics:
+        return jsonify({'error': '가사 미입력'}), 400
+    try:
+        job = jobs.submit(lyrics, genre)
+    except queue.Full:
+        return jsonify({'error': '대기열이 가득 찼습니다. 잠시 후 다시 시도해주세요.'}), 503
+    return jsonify(job_response(job)), 202
+
+# 1-1) 예전 동기 API (호환용): job 을 등록하고 끝날 때까지 기다렸다가 결과물 URL 을 돌려준다
 @app.route('/generate', methods=['POST'])
 def generate():
     lyrics = request.form.get('lyrics', '')
     genre  = request.form.get('genre', 'pop')
     if not lyrics:
         return jsonify({'error': '가사 미입력'}), 400
+    try:
+        job = jobs.submit(lyrics, genre)
+    except queue.Full:
+        return jsonify({'error': '대기열이 가득 찼습니다. 잠시 후 다시 시도해주세요.'}), 503
+    job.wait()
+    if job.status != DONE:
+        return jsonify({'error': job.error or 'MP3 파일 생성 실패'}), 500
+    return jsonify({'job_id': job.id, 'artifacts': job_response(job)['artifacts']})
+
+# 2) job 상태 조회 (폴링)
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'job 없음'}), 404
+    return jsonify(job_response(job))
 
-    # query param 'file'로 mp3/pdf 선택
-    file_type = request.args.get('file', 'mp3')
-    mp3_path = yue_generate(lyrics, genre)
+# 3) 진행 상황 SSE 스트림 (stage1 구간 / stage2 배치 / vocoder)
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'job 없음'}), 404
+    return Response(stream_with_context(job.stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-    if file_type == 'pdf':
-        pdf_path = os.path.join("output", "score.pdf")  # yue_infer.py에서 PDF 생성 경로에 맞춰 조정
-        return send_file(pdf_path, as_attachment=True, download_name="score.pdf")
-    elif mp3_path:
-        return send_file(mp3_path, as_attachment=True, download_name="song.mp3")
+# 4) 생성 중 미리듣기: 디코딩된 오디오를 나오는 대로 WAV 로 흘려보낸다
+@app.route('/jobs/<job_id>/stream')
+def stream_audio(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'job 없음'}), 404
+    # 스트림은 job 이 대기열에 들어갈 때 만들어진다. 없으면 이미 생성이 끝났거나(캐시 결과 포함)
+    # 막 끝나 스트림이 정리된 사이라서, 후자면 결과 mp3 가 나올 때까지 잠깐 기다린다
+    stream = job.audio
+    if stream is None and job.status == RUNNING:
+        job.wait(30)
+    if stream is None:
+        if job.status == DONE and 'mp3' in job.artifacts:
+            return send_file(job.artifacts['mp3'], mimetype='audio/mpeg')
+        return jsonify({'error': '스트림 없음'}), 404
+
+    def generate():
+        yield wav_header(STREAM_SAMPLE_RATE)
+        yield from stream.iter()
+    return Response(stream_with_context(generate()), mimetype='audio/wav',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# 5) 배치 생성: JSONL 매니페스트(본문 또는 manifest 파일)를 받아 한 job 으로 돌린다
+@app.route('/batch', methods=['POST'])
+def create_batch():
+    upload = request.files.get('manifest')
+    try:
+        text = upload.read().decode('utf-8') if upload else request.get_data(as_text=True)
+        # 서버에서는 *_txt 경로 / 파일 경로 파라미터를 받지 않고, 숫자 파라미터도 허용 범위 안에서만 받는다
+        records = batch_runner.read_manifest(text.splitlines(), base_dir=None)
+    except ValueError as e:
+        return jsonify({'error': f'매니페스트 오류: {e}'}), 400
+    if not records:
+        return jsonify({'error': '곡이 없습니다'}), 400
+    try:
+        job = batch_jobs.submit('', 'batch', {'records': records})
+    except queue.Full:
+        return jsonify({'error': '배치 대기열이 가득 찼습니다. 잠시 후 다시 시도해주세요.'}), 503
+    return jsonify(batch_response(job)), 202
+
+def batch_response(job):
+    data = job.to_dict()
+    data["events_url"] = f"/batch/{job.id}/events"
+    data["songs"] = {}
+    for record_id, entry in batch_songs(job.id).items():
+        entry = {key: entry.get(key) for key in ("status", "error", "timings", "seed")}
+        if entry["status"] == "done":
+            entry["mp3_url"] = f"/batch/{job.id}/songs/{record_id}"
+        data["songs"][record_id] = entry
+    if job.status == DONE:
+        data["artifacts"] = {"manifest": f"/artifacts/{job.id}/manifest"}
+    return data
+
+@app.route('/batch/<job_id>')
+def get_batch(job_id):
+    job = batch_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': '배치 없음'}), 404
+    return jsonify(batch_response(job))
+
+@app.route('/batch/<job_id>/events')
+def batch_events(job_id):
+    job = batch_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': '배치 없음'}), 404
+    return Response(stream_with_context(job.stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/batch/<job_id>/songs/<record_id>')
+def download_batch_song(job_id, record_id):
+    # 메모리에서 잊힌 배치도 매니페스트가 남아 있으면 받을 수 있다
+    entry = batch_songs(job_id).get(record_id) if finished_job_dir(job_id) else None
+    if entry is None or entry.get("status") != "done":
+        return jsonify({'error': '결과물 없음'}), 404
+    return send_file(entry["outputs"]["vocoder_mix"], as_attachment=True, download_name=f"{record_id}.mp3")
+
+# 6) Prometheus 지표: 단계별 소요 시간·토큰 수·최대 메모리, 곡 수, 대기열 상태
+@app.route('/metrics')
+def metrics_endpoint():
+    for name, job_queue in (("song", jobs), ("batch", batch_jobs)):
+        for status, count in job_queue.stats().items():
+            metrics.REGISTRY.set("jobs", count, queue=name, status=status)
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+# 7) 결과물 다운로드
+@app.route('/artifacts/<job_id>/<name>')
+def download_artifact(job_id, name):
+    job = jobs.get(job_id) or batch_jobs.get(job_id)
+    if job is not None:
+        path = job.artifacts.get(name)
     else:
-        return jsonify({'error': 'MP3 파일 생성 실패'}), 500
+        # 메모리에서 잊힌 job: 결과물 폴더에 남아 있는 파일
+        job_dir = finished_job_dir(job_id)
+        path = os.path.join(job_dir, ARTIFACT_NAMES[name]) if job_dir and name in ARTIFACT_NAMES else None
+        path = path if path and os.path.isfile(path) else None
+    if path is None:
+        return jsonify({'error': '결과물 없음'}), 404
+    return send_file(path, as_attachment=True, download_name=ARTIFACT_NAMES[name])
+
+def finished_job_dir(job_id):
+    # job id 는 uuid hex 만 받는다 (경로 조작 방지)
+    if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+        return None
+    job_dir = os.path.join(RESULTS_DIR, job_id)
+    return job_dir if os.path.isdir(job_dir) else None
 
 if __name__ == '__main__':
+    # 모델 미리 로드 + torch.compile 워밍업 (첫 요청에서 콜드스타트 비용을 내지 않도록)
+    # 컴파일 결과는 디스크 캐시에 남아서 재시작한 워커는 훨씬 빨리 뜬다
+    get_engine().warmup()
     # ngrok 터널 열기
     public_url = ngrok.connect(5000)
     print(f"▶ ngrok URL: {public_url}")
     # Flask 실행
-    app.run(host='0.0.0.0', port=5000)
+    app.run(host='0.0.0.0', port=5000, threaded=True)
@@ -0,0 +1,224 @@
+# job_queue.py
+# 생성 요청을 job 으로 받아서 고정된 개수의 워커 스레드가 순서대로 처리한다.
+# HTTP 요청은 job id 만 받고 바로 끝나고, 진행 상황은 폴링(GET) 이나 SSE 로 확인한다.
+import json
+import time
+import uuid
+import queue
+import hashlib
+import threading
+from collections import OrderedDict
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+def job_key(lyrics, genre, params=None):
+    payload = json.dumps([lyrics, genre, params or {}], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ByteStream:
+    # 생성 중에 나오는 데이터(오디오 PCM 등)를 쌓아두고, 구독자마다 처음부터 따라 읽는다
+    def __init__(self):
+        self._chunks = []
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def write(self, data):
+        with self._cond:
+            self._chunks.append(data)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def iter(self, keepalive=15):
+        idx = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: idx < len(self._chunks) or self.closed, keepalive)
+                new_chunks = self._chunks[idx:]
+                idx += len(new_chunks)
+                finished = self.closed and idx >= len(self._chunks)
+            yield from new_chunks
+            if finished:
+                return
+
+
+class Job:
+    def __init__(self, lyrics, genre, params=None):
+        self.id = uuid.uuid4().hex
+        self.key = job_key(lyrics, genre, params)
+        self.lyrics = lyrics
+        self.genre = genre
+        self.params = dict(params or {})
+        self.status = QUEUED
+        self.progress = {}      # stage -> {"done": n, "total": m}
+        self.artifacts = {}     # 이름 -> 경로
+        self.error = None
+        self.audio = None       # 대기 / 실행 중일 때만: 미리듣기 오디오 ByteStream
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._events = []       # (event, data) 순서대로 쌓아두고 SSE 구독자가 따라 읽는다
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def emit(self, event, data):
+        with self._cond:
+            self._events.append((event, data))
+            self._cond.notify_all()
+
+    def set_status(self, status, **extra):
+        self.status = status
+        self.emit("status", dict(status=status, **extra))
+
+    def on_progress(self, stage, done, total):
+        # yue_infer 의 각 단계 루프에서 호출된다
+        self.progress[stage] = {"done": done, "total": total}
+        self.emit("progress", {"stage": stage, "done": done, "total": total})
+
+    def wait(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.finished, timeout)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "progress": self.progress,
+            "artifacts": sorted(self.artifacts),
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    def stream(self, keepalive=15):
+        # text/event-stream 포맷으로 지금까지의 이벤트 + 이후 이벤트를 끝날 때까지 내보낸다
+        idx = 0
+        while True:
+            with self._cond:
+                if idx >= len(self._events) and not self.finished:
+                    self._cond.wait(keepalive)
+                new_events = self._events[idx:]
+                idx += len(new_events)
+                finished = self.finished and idx >= len(self._events)
+            if not new_events and not finished:
+                yield ": keepalive\n\n"
+            for event, data in new_events:
+                yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+            if finished:
+                return
+
+
+class JobQueue:
+    def __init__(self, runner, workers=1, max_queued=32, fast_path=None, finished_ttl=3600, max_finished=256,
+                 audio_streams=False):
+        # runner(job) -> {이름: 경로}; job.on_progress 로 진행 상황을 보고한다
+        # fast_path(job) -> {이름: 경로} 또는 None; 캐시 등으로 바로 끝낼 수 있으면 큐를 거치지 않는다
+        # audio_streams 면 큐에 넣을 때 job.audio(ByteStream) 를 만들어 둔다: 워커가 시작하기 전에도
+        # 미리듣기 구독자가 붙을 수 있고, 다 쓰면 runner 가 닫는다
+        # 끝난 job 은 finished_ttl 초가 지나거나 max_finished 개를 넘으면 오래된 것부터 잊는다
+        # (결과물은 결과 캐시에 남아 있어서 같은 요청을 다시 보내면 바로 끝난다)
+        self._runner = runner
+        self._fast_path = fast_path
+        self._finished_ttl = finished_ttl
+        self._max_finished = max_finished
+        self._audio_streams = audio_streams
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs = {}
+        self._finished = OrderedDict()  # 끝난 job id -> 끝난 시각, 끝난 순서대로
+        self._inflight = {}     # key -> 아직 끝나지 않은 Job
+        self._lock = threading.Lock()
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True).start()
+
+    def submit(self, lyrics, genre, params=None):
+        # 같은 입력으로 대기/진행 중인 job 이 있으면 그 job 을 그대로 돌려준다.
+        # 큐가 가득 차 있으면 queue.Full 이 올라간다.
+        key = job_key(lyrics, genre, params)
+        with self._lock:
+            self._evict_finished()
+            job = self._inflight.get(key)
+            if job is not None:
+                return job
+        job = Job(lyrics, genre, params)
+        # 캐시 조회 / 파일 복사(처음이면 모델 로딩까지)는 lock 밖에서 한다
+        artifacts = self._fast_path(job) if self._fast_path else None
+        with self._lock:
+            if artifacts is not None:
+                job.artifacts = artifacts
+                job.started_at = job.finished_at = time.time()
+                job.set_status(DONE, artifacts=sorted(job.artifacts))
+                self._jobs[job.id] = job
+                self._finish(job)
+            else:
+                # 그 사이에 같은 입력의 job 이 등록됐으면 그쪽을 돌려준다
+                inflight = self._inflight.get(key)
+                if inflight is not None:
+                    return inflight
+                # 상태 이벤트를 먼저 남기고 큐에 넣어야 워커의 running 이벤트보다 앞선다
+                job.set_status(QUEUED)
+                if self._audio_streams:
+                    job.audio = ByteStream()
+                self._queue.put_nowait(job)
+                self._inflight[key] = job
+                self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        # 새 job 이 끝나지 않는 한가한 서버에서도 조회할 때 보관 기간이 지난 job 을 잊는다
+        with self._lock:
+            self._evict_finished()
+            return self._jobs.get(job_id)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        # 상태별 job 수 (/metrics 용)
+        counts = dict.fromkeys((QUEUED, RUNNING, DONE, FAILED), 0)
+        with self._lock:
+            self._evict_finished()
+            for job in self._jobs.values():
+                counts[job.status] += 1
+        return counts
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            job.started_at = time.time()
+            job.set_status(RUNNING)
+            try:
+                job.artifacts = self._runner(job)
+                job.finished_at = time.time()
+                job.set_status(DONE, artifacts=sorted(job.artifacts))
+            except Exception as e:
+                job.error = str(e)
+                job.finished_at = time.time()
+                job.set_status(FAILED, error=job.error)
+            finally:
+                with self._lock:
+                    self._inflight.pop(job.key, None)
+                    self._finish(job)
+                self._queue.task_done()
+
+    def _finish(self, job):
+        # lock 을 잡은 채로 호출: 끝난 job 을 기록하고 보관 기간 / 개수를 넘은 job 을 지운다
+        self._finished[job.id] = job.finished_at or time.time()
+        self._evict_finished()
+
+    def _evict_finished(self):
+        # lock 을 잡은 채로 호출
+        while self._finished:
+            job_id, finished_at = next(iter(self._finished.items()))
+            if len(self._finished) <= self._max_finished and time.time() - finished_at <= self._finished_ttl:
+                break
+            del self._finished[job_id]
+            self._jobs.pop(job_id, None)
@@ -0,0 +1,202 @@
+# lyrics_service.py
+# 주제로 가사를 생성한다. 백엔드(OpenAI 호환 API / 네트워크 없는 로컬 대체 모델)는 바꿔 끼울 수 있고,
+# 토큰은 나오는 대로 흘려보내며, 정규화한 주제가 같으면 TTL/LRU 캐시에서 바로 돌려준다.
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+PROMPT = "'{topic}'라는 주제로 16마디 분량의 한국어 노래 가사를 만들어줘. 운율과 구성을 신경 써서 작성해줘."
+
+# 다시 시도할 만한 응답 (요청 과다 / 서버 쪽 일시 오류)
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class LyricsError(RuntimeError):
+    pass
+
+
+def clean_topic(topic):
+    # 전각/반각, 연속 공백 차이를 없앤 주제 (프롬프트에 들어가는 형태)
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", topic)).strip()
+
+
+def topic_key(topic):
+    # 캐시 키: 대소문자까지 무시한다
+    return clean_topic(topic).casefold()
+
+
+class TopicCache:
+    # 주제 -> 가사. 오래된 항목(ttl 초)은 버리고, max_entries 를 넘으면 가장 오래 안 쓴 것부터 지운다
+    def __init__(self, max_entries=256, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key -> (가사, 만료 시각)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, lyrics):
+        with self._lock:
+            self._entries[key] = (lyrics, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class OpenAIBackend:
+    # OpenAI 호환 /chat/completions 를 stream=True 로 호출한다. base_url 을 바꾸면 픽스처 서버로도 쓸 수 있다.
+    # 연결은 세션 풀로 재사용하고, 연결 실패 / 429 / 5xx 는 첫 토큰 전까지 지수 백오프로 다시 시도한다
+    name = "openai"
+
+    def __init__(self, api_key, model="gpt-3.5-turbo", base_url="https://api.openai.com/v1",
+                 timeout=60.0, connect_timeout=5.0, read_timeout=20.0, retries=3, backoff=0.5, pool_size=8):
+        self.model = model
+        self.url = base_url.rstrip("/") + "/chat/completions"
+        self.timeout = timeout                      # 생성 전체에 걸리는 최대 시간
+        self.request_timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+    def stream(self, prompt, max_tokens=256, temperature=0.8):
+        deadline = time.monotonic() + self.timeout
+        body = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "stream": True,
+        }
+        r = self._post(body, deadline)
+        r.encoding = "utf-8"
+        try:
+            for line in r.iter_lines(decode_unicode=True):
+                if time.monotonic() > deadline:
+                    raise LyricsError(f"{self.timeout:.0f}초 안에 끝나지 않았습니다")
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                try:
+                    choices = json.loads(data)["choices"]
+                    # 사용량 / keep-alive 조각은 choices 가 비어 있다
+                    delta = choices[0].get("delta", {}).get("content") if choices else None
+                except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                    raise LyricsError(f"잘못된 응답 조각: {data[:200]}") from e
+                if delta:
+                    yield delta
+        except requests.RequestException as e:
+            raise LyricsError(f"응답 수신 중 오류: {e}") from e
+        finally:
+            r.close()
+
+    def _post(self, body, deadline):
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            try:
+                r = self.session.post(self.url, json=body, stream=True, timeout=self.request_timeout)
+            except requests.RequestException as e:
+                error = LyricsError(f"요청 실패: {e}")
+            else:
+                if r.ok:
+                    return r
+                error = LyricsError(f"HTTP {r.status_code}: {r.text[:200]}")
+                retry_after = r.headers.get("Retry-After")
+                r.close()
+                if r.status_code not in RETRY_STATUS:
+                    raise error
+            delay = self.backoff * 2 ** attempt * (1 + random.random())
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            if attempt == self.retries or time.monotonic() + delay > deadline:
+                raise error
+            metrics.REGISTRY.inc("lyrics_retries_total", backend=self.name)
+            time.sleep(delay)
+
+
+class LocalBackend:
+    # 테스트 / 부하 테스트용 대체 모델: 네트워크 없이 프롬프트마다 정해진 가사를 단어 단위로 흘려보낸다
+    name = "local"
+
+    WORDS = ["밤하늘", "너와", "나", "별빛", "바람", "노래", "기억", "우리", "여름", "파도",
+             "눈물", "웃음", "꿈", "거리", "불빛", "다시", "함께", "멀리", "조용히", "빛나"]
+
+    def __init__(self, token_delay=0.0, lines=16, words_per_line=5):
+        self.token_delay = token_delay
+        self.lines = lines
+        self.words_per_line = words_per_line
+
+    def stream(self, prompt, max_tokens=256, temperature=0.8):
+        rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+        tokens = 0
+        for _ in range(self.lines):
+            for n in range(self.words_per_line):
+                if tokens >= max_tokens:
+                    return
+                if self.token_delay:
+                    time.sleep(self.token_delay)
+                yield rng.choice(self.WORDS) + (" " if n + 1 < self.words_per_line else "\n")
+                tokens += 1
+
+
+BACKENDS = {"openai": OpenAIBackend, "local": LocalBackend}
+
+
+def make_backend(name, **options):
+    if name not in BACKENDS:
+        raise ValueError(f"알 수 없는 가사 생성 백엔드: {name} (가능: {', '.join(sorted(BACKENDS))})")
+    return BACKENDS[name](**options)
+
+
+class LyricsService:
+    def __init__(self, backend, cache=None, max_tokens=256, temperature=0.8):
+        self.backend = backend
+        self.cache = cache
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+
+    def stream(self, topic):
+        # 가사 조각을 나오는 대로 내보낸다. 캐시에 있으면 한 번에 전부 내보낸다
+        key = topic_key(topic)
+        cached = self.cache.get(key) if self.cache is not None else None
+        metrics.REGISTRY.inc("lyrics_cache_total", result="miss" if cached is None else "hit")
+        if cached is not None:
+            yield cached
+            return
+        parts = []
+        with metrics.span("lyrics_generation"):
+            for token in self.backend.stream(PROMPT.format(topic=clean_topic(topic)), self.max_tokens, self.temperature):
+                parts.append(token)
+                yield token
+        lyrics = "".join(parts).strip()
+        # 끝까지 받은 가사만 캐시에 넣는다 (중간에 끊긴 스트림은 여기까지 오지 않는다)
+        if lyrics and self.cache is not None:
+            self.cache.put(key, lyrics)
+
+    def generate(self, topic):
+        return "".join(self.stream(topic)).strip()
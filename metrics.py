@@ -0,0 +1,271 @@
+"""Timing spans, counters and peak memory of the generation pipeline.
+
+Code that does a measurable piece of work wraps it in `span(stage)`:
+
+    with metrics.span("codec_decode", frames=codes.shape[-1]):
+        ...
+
+Every span is added to the process-wide REGISTRY, which the Flask apps
+serve in the Prometheus text format at /metrics, and to the JobMetrics of the
+jobs it works for. Those are set per thread with `tracking(*jobs)`: a stage-2
+batch shared by several songs counts for each of them. A JobMetrics ends up
+as the timings.json written next to a job's outputs.
+
+torch is only used if it is already imported, so the web front end can serve
+its own /metrics without it.
+"""
+import os
+import sys
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the duration histogram buckets
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, float("inf"))
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels)) + "}"
+
+
+class Registry:
+    """Counters, max-gauges and duration histograms in the Prometheus text format."""
+
+    def __init__(self, prefix="yue"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}     # (name, labels) -> value
+        self._gauges = {}       # (name, labels) -> value
+        self._histograms = {}   # (name, labels) -> [bucket counts, sum, count]
+        self._help = {}
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def set_max(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = max(self._gauges.get(key, value), value)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        """The text exposition format (version 0.0.4)."""
+        lines = []
+
+        def header(name, kind):
+            full = f"{self.prefix}_{name}"
+            if name in self._help:
+                lines.append(f"# HELP {full} {self._help[name]}")
+            lines.append(f"# TYPE {full} {kind}")
+            return full
+        with self._lock:
+            for kind, series in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted({name for name, _ in series}):
+                    full = header(name, kind)
+                    for (other, labels), value in sorted(series.items()):
+                        if other == name:
+                            lines.append(f"{full}{_label_text(labels)} {value}")
+            for name in sorted({name for name, _ in self._histograms}):
+                full = header(name, "histogram")
+                for (other, labels), (buckets, total, count) in sorted(self._histograms.items()):
+                    if other != name:
+                        continue
+                    for bound, n in zip(BUCKETS, buckets):
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{full}_bucket{_label_text(labels + (('le', le),))} {n}")
+                    lines.append(f"{full}_sum{_label_text(labels)} {total}")
+                    lines.append(f"{full}_count{_label_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+REGISTRY.describe("stage_seconds", "Wall time of pipeline spans by stage.")
+REGISTRY.describe("stage_tokens_total", "Tokens processed by stage-1 prefill and decode spans.")
+REGISTRY.describe("stage_peak_device_bytes", "Highest device memory allocated during a span, by stage.")
+REGISTRY.describe("peak_rss_bytes", "Peak resident set size of the process.")
+REGISTRY.describe("invalid_codes_repaired_total", "Stage-2 codes outside the codebook replaced by fix_invalid_codes.")
+REGISTRY.describe("phase_seconds", "Per-song time of the stage1, stage2_decode and total phases.")
+REGISTRY.describe("songs_total", "Songs finished, by status.")
+REGISTRY.describe("jobs", "Jobs known to a server queue, by status.")
+REGISTRY.describe("queue_wait_seconds", "Time jobs spent queued before a worker took them.")
+REGISTRY.describe("http_request_seconds", "Time to produce a response, by endpoint.")
+REGISTRY.describe("http_requests_total", "Responses by endpoint and status code.")
+REGISTRY.describe("lyrics_cache_total", "Lyrics requests answered from the topic cache (hit) or by the backend (miss).")
+REGISTRY.describe("lyrics_retries_total", "Lyrics backend requests retried after a connection error, 429 or 5xx.")
+
+_jobs = contextvars.ContextVar("yue_metrics_jobs", default=())
+_open_spans = 0
+_open_lock = threading.Lock()
+
+
+def _torch():
+    return sys.modules.get("torch")
+
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _cuda():
+    torch = _torch()
+    return torch if torch is not None and torch.cuda.is_available() else None
+
+
+class JobMetrics:
+    """Spans and counts of one job, as written to its timings.json."""
+
+    def __init__(self, **info):
+        self.info = info
+        self.started = time.time()
+        self.spans = []     # {"stage", "start", "seconds", ...attributes}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, record):
+        with self._lock:
+            self.spans.append(dict(record, start=record["start"] - self.started))
+
+    def count(self, name, value):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def to_dict(self, timings=None):
+        with self._lock:
+            spans = list(self.spans)
+            counts = dict(self.counts)
+        stages = {}
+        for record in spans:
+            stage = stages.setdefault(record["stage"], {"count": 0, "seconds": 0.0})
+            stage["count"] += 1
+            stage["seconds"] += record["seconds"]
+            for key in ("tokens", "peak_device_bytes"):
+                if key in record:
+                    stage[key] = (max if key.startswith("peak") else sum)((stage.get(key, 0), record[key]))
+        for name, stage in stages.items():
+            if stage.get("tokens"):
+                stage["tokens_per_second"] = stage["tokens"] / stage["seconds"] if stage["seconds"] else None
+        return {
+            **self.info,
+            "timings": timings or {},
+            "stages": stages,
+            "counts": counts,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "spans": spans,
+        }
+
+    def write(self, path, timings=None):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(timings), f, indent=2)
+
+
+@contextmanager
+def tracking(*jobs):
+    """Attribute the spans of this thread (and of threads started with `bind`) to `jobs`."""
+    token = _jobs.set(tuple(job for job in jobs if job is not None))
+    try:
+        yield
+    finally:
+        _jobs.reset(token)
+
+
+def bind(fn):
+    """`fn` running with the jobs tracked by the calling thread, for handing to another thread."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+def count(name, value=1, **labels):
+    REGISTRY.inc(f"{name}_total", value, **labels)
+    for job in _jobs.get():
+        job.count(name, value)
+
+
+def record(stage, seconds, start=None, **attributes):
+    """Add a span measured elsewhere, e.g. per-segment stage-1 prefill and decode times."""
+    REGISTRY.observe("stage_seconds", seconds, stage=stage)
+    if "tokens" in attributes:
+        REGISTRY.inc("stage_tokens_total", attributes["tokens"], stage=stage)
+    if "peak_device_bytes" in attributes:
+        REGISTRY.set_max("stage_peak_device_bytes", attributes["peak_device_bytes"], stage=stage)
+    entry = dict(attributes, stage=stage, start=time.time() - seconds if start is None else start, seconds=seconds)
+    for job in _jobs.get():
+        job.add_span(entry)
+
+
+@contextmanager
+def span(stage, sync=False, **attributes):
+    """Time the block as `stage`; the yielded dict takes attributes known only at the end.
+
+    Peak device memory is the highest allocation seen during the block. The
+    counter is only reset when no other span is open, so with concurrent
+    spans it is the peak since the earliest of them began. With `sync` the
+    device is synchronised first, so that queued kernels count for the span.
+    """
+    global _open_spans
+    cuda = _cuda()
+    with _open_lock:
+        if cuda is not None and _open_spans == 0:
+            cuda.cuda.reset_peak_memory_stats()
+        _open_spans += 1
+    wall = time.time()
+    start = time.perf_counter()
+    extra = dict(attributes)
+    try:
+        yield extra
+    finally:
+        if cuda is not None and sync:
+            cuda.cuda.synchronize()
+        seconds = time.perf_counter() - start
+        with _open_lock:
+            _open_spans -= 1
+        if cuda is not None:
+            extra["peak_device_bytes"] = cuda.cuda.max_memory_allocated()
+        record(stage, seconds, start=wall, **extra)
+        rss = peak_rss_bytes()
+        if rss is not None:
+            REGISTRY.set_max("peak_rss_bytes", rss)
+
+
+@contextmanager
+def profiled(path):
+    """Record a torch profiler trace of the block to `path` (Chrome trace JSON); no-op for an empty path."""
+    if not path:
+        yield
+        return
+    import torch
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True) as profiler:
+        yield
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    profiler.export_chrome_trace(path)
@@ -0,0 +1,260 @@
+import os
+import time
+import atexit
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+DEVICE, HOST, DISK = "device", "host", "disk"
+
+
+class _Entry:
+    def __init__(self, name, module, pinned, static=False):
+        self.name = name
+        self.module = module
+        self.pinned = pinned
+        self.static = static
+        # (owning module, "_parameters" or "_buffers", key) of every weight tensor;
+        # tied parameters are the same object and are only listed once
+        self.slots = []
+        seen = set()
+        for owner in module.modules():
+            for kind in ("_parameters", "_buffers"):
+                for key, tensor in getattr(owner, kind).items():
+                    if tensor is not None and id(tensor) not in seen:
+                        seen.add(id(tensor))
+                        self.slots.append((owner, kind, key))
+        self.size = sum(self.get(slot).numel() * self.get(slot).element_size() for slot in self.slots)
+        self.host = None        # slot index -> host copy (pinned RAM, or mmap'd from the spill file)
+        self.host_tier = HOST
+        self.on_device = False
+        self.users = 0
+        self.last_used = 0.0
+        self.prefetch = None    # Future of the last prefetch
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get(slot):
+        owner, kind, key = slot
+        return getattr(owner, kind)[key]
+
+    @staticmethod
+    def set(slot, tensor):
+        owner, kind, key = slot
+        if kind == "_parameters":
+            getattr(owner, kind)[key].data = tensor
+        else:
+            getattr(owner, kind)[key] = tensor
+
+
+class ResidencyManager:
+    """Keeps the weights of registered models on the device within a byte budget.
+
+    Every model has a host copy of its weights: pinned RAM while the host
+    budget allows, otherwise a file in `spill_dir` that is memory-mapped back.
+    Weights never change during inference, so evicting a model from the device
+    only drops its device tensors, and bringing it back is one host-to-device
+    copy, on a side stream so that prefetches overlap the running stage.
+    Models in use are never evicted; the least recently used idle ones go
+    first. A model that does not fit even then is loaded over budget.
+    On a CPU device, and for models registered as `static` (e.g. ones that
+    run on the CPU next to a GPU), everything simply stays where it is.
+    """
+
+    def __init__(self, device, device_budget=None, host_budget=None, spill_dir=None):
+        self.device = torch.device(device)
+        self.enabled = self.device.type == "cuda"
+        if self.enabled and not device_budget:
+            device_budget = int(0.6 * torch.cuda.get_device_properties(self.device).total_memory)
+        self.device_budget = device_budget
+        self.host_budget = host_budget
+        self.spill_dir = None
+        if spill_dir and host_budget:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.spill_dir = tempfile.mkdtemp(prefix="weights-", dir=spill_dir)
+            atexit.register(shutil.rmtree, self.spill_dir, ignore_errors=True)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="weights-prefetch")
+        self._copy_stream = torch.cuda.Stream(self.device) if self.enabled else None
+
+    def register(self, name, module, pinned=False, static=False):
+        """Track `module` (on the CPU) under `name`; `pinned` models are loaded now and
+        never evicted, `static` ones are left where they are and never paged."""
+        entry = _Entry(name, module, pinned, static or not self.enabled)
+        with self._lock:
+            self._entries[name] = entry
+        if entry.static:
+            entry.on_device = True
+            return module
+        entry.host = {}
+        for idx, slot in enumerate(entry.slots):
+            tensor = entry.get(slot).detach().cpu()
+            try:
+                tensor = tensor.pin_memory()
+            except RuntimeError:
+                pass  # not enough page-locked memory; copies are just slower
+            entry.host[idx] = tensor
+            entry.set(slot, tensor)
+        with self._lock:
+            self._fit_host(exclude=entry)
+            if self.host_budget and self._host_bytes() > self.host_budget:
+                self._spill(entry)
+        if pinned:
+            with entry.lock:
+                self._load(entry)
+        return module
+
+    @contextmanager
+    def use(self, *names):
+        """Keep the named models on the device for the duration of the block."""
+        entries = [self._entries[name] for name in names]
+        with self._lock:
+            for entry in entries:
+                entry.users += 1
+        try:
+            for entry in entries:
+                self._ensure(entry)
+            yield
+        finally:
+            with self._lock:
+                for entry in entries:
+                    entry.users -= 1
+                    entry.last_used = time.monotonic()
+
+    def prefetch(self, *names):
+        """Start copying the named models to the device if they fit without evicting models in use."""
+        if not self.enabled:
+            return
+        for name in names:
+            entry = self._entries[name]
+            with self._lock:
+                if entry.static or entry.on_device or self._prefetching(entry):
+                    continue
+                if not self._make_room(entry.size, exclude=entry, force=False):
+                    continue
+                entry.prefetch = self._prefetcher.submit(self._prefetch, entry)
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {"bytes": e.size, "tier": DEVICE if e.on_device else e.host_tier, "users": e.users}
+                for name, e in self._entries.items()
+            }
+
+    def _prefetch(self, entry):
+        with entry.lock:
+            self._load(entry)
+
+    def _ensure(self, entry):
+        if entry.static:
+            return
+        if entry.prefetch is not None:
+            entry.prefetch.result()
+        with entry.lock:
+            if entry.on_device:
+                return
+            with self._lock:
+                if not self._make_room(entry.size, exclude=entry, force=True):
+                    print(f"Loading {entry.name} over the device weight budget ({self.device_budget / 1024**3:.1f} GB)")
+            self._load(entry)
+        self._promote(entry)
+
+    def _load(self, entry):
+        # called with entry.lock held
+        if not entry.on_device:
+            with torch.cuda.stream(self._copy_stream):
+                for idx, slot in enumerate(entry.slots):
+                    entry.set(slot, entry.host[idx].to(self.device, non_blocking=True))
+            self._copy_stream.synchronize()
+        with self._lock:
+            entry.on_device = True
+            entry.last_used = time.monotonic()
+
+    def _evict(self, entry):
+        # called with self._lock held; the host copy is still valid, so nothing is copied back
+        for idx, slot in enumerate(entry.slots):
+            entry.set(slot, entry.host[idx])
+        entry.on_device = False
+
+    @staticmethod
+    def _prefetching(entry):
+        return entry.prefetch is not None and not entry.prefetch.done()
+
+    def _device_bytes(self, exclude=None):
+        return sum(e.size for e in self._entries.values()
+                   if e is not exclude and not e.static and (e.on_device or self._prefetching(e)))
+
+    def _make_room(self, size, exclude, force):
+        """Evict idle models, least recently used first, until `size` more bytes fit.
+
+        Called with self._lock held. Returns whether it fits; without `force`
+        nothing is evicted unless that makes it fit.
+        """
+        idle = sorted(
+            (e for e in self._entries.values()
+             if e is not exclude and e.on_device and not e.users and not e.pinned and not e.static
+             and not self._prefetching(e)),
+            key=lambda e: e.last_used,
+        )
+        needed = self._device_bytes(exclude) + size - self.device_budget
+        if needed > 0 and not force and sum(e.size for e in idle) < needed:
+            return False
+        evicted = False
+        for e in idle:
+            if needed <= 0:
+                break
+            self._evict(e)
+            evicted = True
+            needed -= e.size
+        if evicted:
+            torch.cuda.empty_cache()
+        return needed <= 0
+
+    def _host_bytes(self):
+        return sum(e.size for e in self._entries.values() if e.host_tier == HOST and not e.static)
+
+    def _fit_host(self, exclude):
+        # called with self._lock held: spill least recently used pinned copies to disk
+        if not self.host_budget:
+            return
+        for e in sorted(self._entries.values(), key=lambda e: e.last_used):
+            if self._host_bytes() <= self.host_budget:
+                break
+            if e is not exclude and e.host_tier == HOST:
+                self._spill(e)
+
+    def _spill(self, entry):
+        """Replace the pinned host copy by a memory-mapped file."""
+        if self.spill_dir is None:
+            return
+        path = os.path.join(self.spill_dir, f"{entry.name}.pt")
+        if not os.path.exists(path):
+            torch.save({idx: tensor for idx, tensor in entry.host.items()}, path)
+        entry.host = torch.load(path, mmap=True, weights_only=True)
+        if not entry.on_device:
+            for idx, slot in enumerate(entry.slots):
+                entry.set(slot, entry.host[idx])
+        entry.host_tier = DISK
+
+    def _promote(self, entry):
+        """Pin a model that was paged in from disk again if colder ones can make room for it."""
+        if entry.host_tier != DISK:
+            return
+        with self._lock:
+            entry.host_tier = HOST
+            self._fit_host(exclude=entry)
+            if self._host_bytes() > self.host_budget:
+                entry.host_tier = DISK
+                return
+            pinned = {}
+            for idx, tensor in entry.host.items():
+                try:
+                    pinned[idx] = tensor.pin_memory()
+                except RuntimeError:
+                    pinned[idx] = tensor.clone()
+            entry.host = pinned
@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+
+def cache_key(*parts):
+    """Stable hash of JSON-serialisable parts (dicts are key-sorted)."""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Content-addressed on-disk cache of pipeline outputs.
+
+    Each entry is a directory `<root>/<key>/` holding a fixed set of named files.
+    Entries are independent, so a stage-2 entry stays usable after the final-mix
+    entry built from it has been evicted. The least recently used entries are
+    removed once the total size exceeds `max_bytes`.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> [last_access, size]
+        os.makedirs(root, exist_ok=True)
+        for key in os.listdir(root):
+            path = os.path.join(root, key)
+            if key.startswith(".") or not os.path.isdir(path):
+                continue
+            self._entries[key] = [os.path.getmtime(path), self._dir_size(path)]
+
+    @staticmethod
+    def _dir_size(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    @property
+    def total_bytes(self):
+        return sum(size for _, size in self._entries.values())
+
+    def get(self, key, names):
+        """Return {name: path} if the entry exists and has every name, else None."""
+        path = os.path.join(self.root, key)
+        with self._lock:
+            if key not in self._entries:
+                return None
+            files = {name: os.path.join(path, name) for name in names}
+            if not all(os.path.exists(p) for p in files.values()):
+                return None
+            now = time.time()
+            self._entries[key][0] = now
+            os.utime(path, (now, now))
+        return files
+
+    def restore(self, key, files):
+        """Copy the entry's files to {name: destination}; returns False on miss.
+
+        Restored files are copies rather than links so that a job rewriting its
+        outputs can never modify the cached entry.
+        """
+        cached = self.get(key, list(files))
+        if cached is None:
+            return False
+        try:
+            for name, dst in files.items():
+                os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+                shutil.copyfile(cached[name], dst)
+        except FileNotFoundError:
+            # evicted by a concurrent put() between get() and the copy
+            return False
+        return True
+
+    def put(self, key, files):
+        """Store {name: source path} under key and evict down to the size cap.
+
+        The files are copied, not hard-linked: job outputs, stage intermediates
+        and checkpoints are rewritten in place under the same names, which would
+        change a shared inode in the cache as well.
+        """
+        path = os.path.join(self.root, key)
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.root)
+        try:
+            for name, src in files.items():
+                shutil.copyfile(src, os.path.join(tmp, name))
+            size = self._dir_size(tmp)
+            with self._lock:
+                if key in self._entries:
+                    shutil.rmtree(path, ignore_errors=True)
+                os.replace(tmp, path)
+                self._entries[key] = [time.time(), size]
+                self._evict()
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _evict(self):
+        total = self.total_bytes
+        for key, (_, size) in sorted(self._entries.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+            del self._entries[key]
+            total -= size
@@ -0,0 +1,512 @@
+import time
+import threading
+
+import torch
+import torch.nn.functional as F
+
+
+def last_logits_kwargs(model):
+    """Forward kwargs that make a prefill only materialise last-position logits, if supported."""
+    import inspect
+    params = inspect.signature(getattr(model, "_orig_mod", model).forward).parameters
+    for name in ("logits_to_keep", "num_logits_to_keep"):
+        if name in params:
+            return {name: 1}
+    return {}
+
+
+def _cache_layers(cache):
+    """[(key, value)] per layer of a model's past_key_values, whatever its cache class."""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [(k, v) for k, v in cache]
+
+
+def _make_cache(layers):
+    """Inverse of _cache_layers: build a past_key_values the model accepts."""
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return tuple(layers)
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(layers))
+    cache = DynamicCache()
+    for idx, (k, v) in enumerate(layers):
+        cache.update(k, v, idx)
+    return cache
+
+
+def _merge_caches(requests, cached_lens, length):
+    """Left-pad each request's carried cache to `length` positions and stack them."""
+    layers = []
+    reference = next(r.past_key_values for r, n in zip(requests, cached_lens) if n)
+    for idx, (ref_k, ref_v) in enumerate(reference):
+        keys = ref_k.new_zeros((len(requests),) + ref_k.shape[1:2] + (length,) + ref_k.shape[3:])
+        values = ref_v.new_zeros((len(requests),) + ref_v.shape[1:2] + (length,) + ref_v.shape[3:])
+        for row, (r, n) in enumerate(zip(requests, cached_lens)):
+            if n:
+                k, v = r.past_key_values[idx]
+                keys[row, :, length - n:] = k[0, :, :n]
+                values[row, :, length - n:] = v[0, :, :n]
+        layers.append((keys, values))
+    return _make_cache(layers)
+
+
+def _crop_cache(cache, length):
+    """Drop the cached positions from `length` on (of a batch-1 cache), in place where possible."""
+    if hasattr(cache, "layers"):
+        for layer in cache.layers:
+            layer.keys, layer.values = layer.keys[:, :, :length], layer.values[:, :, :length]
+        return cache
+    if hasattr(cache, "key_cache"):
+        cache.key_cache = [k[:, :, :length] for k in cache.key_cache]
+        cache.value_cache = [v[:, :, :length] for v in cache.value_cache]
+        return cache
+    return _make_cache([(k[:, :, :length], v[:, :, :length]) for k, v in _cache_layers(cache)])
+
+
+def _synchronize(device):
+    # pending kernels must finish before a timestamp is taken
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def _split_cache(cache, attention_mask, row, length):
+    """The first `length` unpadded positions of one row of a batched cache."""
+    positions = attention_mask[row].nonzero().squeeze(1)[:length]
+    return [(k[row:row + 1, :, positions], v[row:row + 1, :, positions]) for k, v in _cache_layers(cache)]
+
+
+class CodecFraming:
+    """Precomputed logits masks that only let stage 1 sample well-formed audio spans.
+
+    A segment's prompt ends in `soa` + separator, so everything sampled is the
+    interleaved vocal/instrumental run of codebook-0 xcodec tokens
+    ([codec_start, codec_end)) closed by `eoa`. Which tokens are legal only
+    depends on how many have been sampled, so there are three masks:
+
+    - codec tokens only: before min_new_tokens, and after an odd count (a
+      vocal token still needs its instrumental partner);
+    - codec tokens or `eoa`: at an even count from min_new_tokens on;
+    - `eoa` only: at an even count that leaves no room for another pair
+      before max_new_tokens, so the run is always closed in time.
+
+    Masking a step is one row gather and one add, for any batch.
+    """
+
+    CODEC, CODEC_OR_END, END = 0, 1, 2
+
+    def __init__(self, eoa_id, codec_start, codec_end):
+        self.eoa_id = eoa_id
+        self.codec_start = codec_start
+        self.codec_end = codec_end
+        self._masks = {}
+
+    def masks(self, vocab_size, device):
+        """(3, vocab_size) additive masks, one row per state."""
+        key = (vocab_size, str(device))
+        if key not in self._masks:
+            masks = torch.full((3, vocab_size), -float("inf"), device=device)
+            masks[[self.CODEC, self.CODEC_OR_END], self.codec_start:self.codec_end] = 0
+            masks[[self.CODEC_OR_END, self.END], self.eoa_id] = 0
+            self._masks[key] = masks
+        return self._masks[key]
+
+    def mask(self, scores, step, min_new_tokens, max_new_tokens):
+        """Additive mask for `scores` (rows, vocab) after `step` sampled tokens per row.
+
+        `step`, `min_new_tokens` and `max_new_tokens` are ints or per-row tensors.
+        """
+        step = torch.as_tensor(step, device=scores.device).expand(scores.shape[0])
+        even = step % 2 == 0
+        state = torch.where(even & (step >= min_new_tokens), self.CODEC_OR_END, self.CODEC)
+        state = torch.where(even & (step + 3 > max_new_tokens), self.END, state)
+        return self.masks(scores.shape[-1], scores.device)[state]
+
+
+def _sampling_probs(logits, uncond_logits, seen, mask, guidance, penalty, temperature, top_p):
+    """Stage-1 next-token distribution for each row of `logits`.
+
+    Classifier-free guidance against `uncond_logits` (if given, for rows whose
+    guidance is not 1), repetition penalty over the `seen` token ids, the
+    additive CodecFraming `mask`, then temperature and top-p.
+    """
+    scores = logits
+    if uncond_logits is not None:
+        cond_logprobs = F.log_softmax(logits, dim=-1)
+        uncond_logprobs = F.log_softmax(uncond_logits, dim=-1)
+        guided = guidance * (cond_logprobs - uncond_logprobs) + uncond_logprobs
+        scores = torch.where(guidance != 1, guided, logits)
+    # repetition penalty
+    score = torch.gather(scores, 1, seen)
+    score = torch.where(score < 0, score * penalty, score / penalty)
+    scores = scores.scatter(1, seen, score)
+    # codec tokens / eoa framing
+    scores = scores + mask
+    # temperature, top-p
+    scores = scores / temperature
+    sorted_scores, sorted_idx = torch.sort(scores, descending=False)
+    cumulative = sorted_scores.softmax(dim=-1).cumsum(dim=-1)
+    sorted_remove = cumulative <= (1 - top_p)
+    sorted_remove[:, -1] = False
+    scores = scores.masked_fill(sorted_remove.scatter(1, sorted_idx, sorted_remove), -float("inf"))
+    return scores.softmax(dim=-1)
+
+
+class SegmentRequest:
+    """One stage-1 lyric segment of one song, waiting to be sampled.
+
+    `input_ids` is the 1-D prompt (previous output + segment prompt). Sampling
+    follows what `model.generate` did for this segment: classifier-free guidance
+    against the last prompt token, repetition penalty over prompt and output,
+    then temperature and top-p, except that only the tokens CodecFraming
+    allows can be drawn: the output is always an even-length codec run of at
+    least `min_new_tokens` closed by `eoa` within `max_new_tokens`. Tokens are drawn from the song's own
+    `generator`, so a seed reproduces the same song whichever other songs
+    share the batch.
+
+    `past_key_values` ([(key, value)] per layer) may hold the song's cache for
+    the first `cached_len` tokens of `input_ids`, carried over from the previous
+    segment, so only the remaining tokens are prefilled. With `keep_cache` the
+    request gets back the cache of its output in the same two fields. Once a
+    song outgrows the context window, only the cache of its header carries
+    over: the windowed tokens after it change positions, so they are prefilled
+    again for every later segment.
+
+    Sampling sets `timings`: the seconds spent on the prefill and on decoding
+    (those of the whole batch the request was part of) and the number of
+    prompt tokens prefilled and new tokens sampled for this request.
+    """
+
+    def __init__(self, input_ids, segment_idx, generator, guidance_scale, max_new_tokens,
+                 min_new_tokens=100, top_p=0.93, temperature=1.0, repetition_penalty=1.1,
+                 past_key_values=None, cached_len=0, keep_cache=False):
+        self.input_ids = input_ids
+        self.segment_idx = segment_idx
+        self.generator = generator
+        self.guidance_scale = guidance_scale
+        self.max_new_tokens = max_new_tokens
+        self.min_new_tokens = min_new_tokens
+        self.top_p = top_p
+        self.temperature = temperature
+        self.repetition_penalty = repetition_penalty
+        self.past_key_values = past_key_values
+        self.cached_len = cached_len if past_key_values is not None else 0
+        self.keep_cache = keep_cache
+        self.output = None
+        self.error = None
+        self.draft_stats = None
+        self.timings = None
+        self.done = threading.Event()
+
+
+@torch.no_grad()
+def sample_segments(model, requests, framing):
+    """Sample a batch of SegmentRequests in one left-padded decoding loop.
+
+    Each row stops at its own `eoa` and is padded with `eoa` afterwards. Rows
+    may carry caches of different lengths. Returns one 1-D tensor per request:
+    prompt followed by the new tokens up to and including its `eoa`, as
+    `model.generate` returned.
+    """
+    eoa_id = framing.eoa_id
+    device = requests[0].input_ids.device
+    batch_size = len(requests)
+    lengths = [r.input_ids.shape[-1] for r in requests]
+    # at least the last prompt token is always fed, it produces the first logits
+    cached_lens = [min(r.cached_len, length - 1) for r, length in zip(requests, lengths)]
+    new_lens = [length - n for length, n in zip(lengths, cached_lens)]
+    max_len, max_cached, max_new = max(lengths), max(cached_lens), max(new_lens)
+    # Row layout: [pad][carried cache][pad][uncached prompt tokens], so every
+    # row's last prompt token sits in the last column
+    input_ids = torch.full((batch_size, max_new), eoa_id, dtype=torch.long, device=device)
+    attention_mask = torch.zeros((batch_size, max_cached + max_new), dtype=torch.long, device=device)
+    prompt_ids = torch.full((batch_size, max_len), eoa_id, dtype=torch.long, device=device)
+    prompt_mask = torch.zeros((batch_size, max_len), dtype=torch.bool, device=device)
+    for row, (r, length, n_cached, n_new) in enumerate(zip(requests, lengths, cached_lens, new_lens)):
+        input_ids[row, max_new - n_new:] = r.input_ids[n_cached:]
+        attention_mask[row, max_cached - n_cached:max_cached] = 1
+        attention_mask[row, max_cached + max_new - n_new:] = 1
+        prompt_ids[row, max_len - length:] = r.input_ids
+        prompt_mask[row, max_len - length:] = True
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, max_cached:]
+    past_key_values = _merge_caches(requests, cached_lens, max_cached) if max_cached else None
+    for r in requests:
+        r.past_key_values = None
+    # Padding must not be penalised: point it at a token the row already has
+    penalty_ids = torch.where(prompt_mask, prompt_ids, prompt_ids[:, -1:])
+
+    def column(name, dtype=torch.float32):
+        return torch.tensor([getattr(r, name) for r in requests], dtype=dtype, device=device).unsqueeze(1)
+    guidance = column("guidance_scale")
+    penalty = column("repetition_penalty")
+    temperature = column("temperature")
+    top_p = column("top_p")
+    min_new_tokens = column("min_new_tokens", torch.long).squeeze(1)
+    max_new_tokens = column("max_new_tokens", torch.long).squeeze(1)
+    use_cfg = bool((guidance != 1).any())
+
+    start = time.perf_counter()
+    out = model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                past_key_values=past_key_values, use_cache=True, **last_logits_kwargs(model))
+    # Unconditional branch of classifier-free guidance starts from the last prompt token
+    uncond = model(input_ids=input_ids[:, -1:], use_cache=True) if use_cfg else None
+    _synchronize(device)
+    prefill_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+
+    generated = []
+    unfinished = torch.ones(batch_size, dtype=torch.bool, device=device)
+    for step in range(int(max_new_tokens.max())):
+        logits = out.logits[:, -1, :].float()
+        probs = _sampling_probs(
+            logits, uncond.logits[:, -1, :].float() if use_cfg else None,
+            torch.cat([penalty_ids] + generated, dim=1), framing.mask(logits, step, min_new_tokens, max_new_tokens),
+            guidance, penalty, temperature, top_p,
+        )
+        next_tokens = torch.cat([
+            torch.multinomial(probs[row], 1, generator=r.generator) for row, r in enumerate(requests)
+        ]).unsqueeze(1)
+
+        next_tokens = torch.where(unfinished.unsqueeze(1), next_tokens, torch.full_like(next_tokens, eoa_id))
+        generated.append(next_tokens)
+        unfinished &= (next_tokens.squeeze(1) != eoa_id) & (step + 1 < max_new_tokens)
+        if not unfinished.any():
+            break
+
+        attention_mask = torch.cat([attention_mask, torch.ones_like(next_tokens)], dim=1)
+        position_ids = position_ids[:, -1:] + 1
+        out = model(input_ids=next_tokens, attention_mask=attention_mask, position_ids=position_ids,
+                    past_key_values=out.past_key_values, use_cache=True)
+        if use_cfg:
+            uncond = model(input_ids=next_tokens, past_key_values=uncond.past_key_values, use_cache=True)
+
+    generated = torch.cat(generated, dim=1)
+    _synchronize(device)
+    decode_seconds = time.perf_counter() - start
+    outputs = []
+    for row, r in enumerate(requests):
+        new_tokens = generated[row, :int(max_new_tokens[row])]
+        eoa_pos = (new_tokens == eoa_id).nonzero()
+        if len(eoa_pos):
+            new_tokens = new_tokens[:int(eoa_pos[0]) + 1]
+        outputs.append(torch.cat([r.input_ids, new_tokens]))
+        r.timings = {"prefill": prefill_seconds, "decode": decode_seconds,
+                     "prefill_tokens": new_lens[row], "new_tokens": new_tokens.shape[-1]}
+        if r.keep_cache:
+            # the cache holds every token fed so far; the last sampled one never was
+            r.cached_len = min(int(attention_mask[row].sum()), outputs[-1].shape[-1])
+            r.past_key_values = _split_cache(out.past_key_values, attention_mask, row, r.cached_len)
+        else:
+            r.cached_len = 0
+    return outputs
+
+
+class _CachedModel:
+    """A model's KV cache over a growing 1-D token sequence, from position `start` on."""
+
+    def __init__(self, model, start=0, cache=None, fed=0):
+        self.model = model
+        self.start = start
+        self.cache = cache
+        self.fed = max(fed, start)  # sequence positions [start, fed) are in the cache
+        self._keep = last_logits_kwargs(model)
+
+    def logits(self, seq, rows=1):
+        """float32 logits after each of the last `rows` positions of `seq`, feeding what the cache lacks."""
+        out = self.model(input_ids=seq[self.fed:].unsqueeze(0), past_key_values=self.cache, use_cache=True,
+                         **{name: rows for name in self._keep})
+        self.cache = out.past_key_values
+        self.fed = seq.shape[-1]
+        return out.logits[0, -rows:].float()
+
+    def rewind(self, length):
+        """Forget the positions from `length` on, e.g. rejected draft tokens."""
+        if self.fed > length:
+            self.cache = _crop_cache(self.cache, length - self.start)
+            self.fed = length
+
+
+@torch.no_grad()
+def sample_segment_speculative(model, draft_model, request, framing, draft_tokens=4):
+    """Speculative sampling of one SegmentRequest.
+
+    `draft_model` (same vocabulary, any size) proposes up to `draft_tokens`
+    tokens one by one from its own distribution q; `model` then scores all of
+    them in one forward pass. Proposal x is kept with probability
+    min(1, p(x) / q(x)), the first rejected one is replaced by a sample from
+    max(0, p - q), and if all are kept one more token is drawn from p. p and q
+    both go through _sampling_probs, guidance branch included, so the output
+    follows exactly the distribution of sample_segments (though not the same
+    random draws for a seed). Returns prompt + new tokens like sample_segments
+    and records proposed/accepted counts in `request.draft_stats`. The
+    `prefill` timing is that of the first round, which also feeds the prompt.
+    """
+    r = request
+    eoa_id = framing.eoa_id
+    device = r.input_ids.device
+    prompt = r.input_ids
+    length = prompt.shape[-1]
+    n_cached = min(r.cached_len, length - 1)
+    cache = _make_cache([(k[:, :, :n_cached], v[:, :, :n_cached]) for k, v in r.past_key_values]) if n_cached else None
+    r.past_key_values = None
+    use_cfg = r.guidance_scale != 1
+    # the unconditional branches start from the last prompt token, as in sample_segments
+    target = _CachedModel(model, cache=cache, fed=n_cached)
+    target_uncond = _CachedModel(model, start=length - 1) if use_cfg else None
+    draft = _CachedModel(draft_model)
+    draft_uncond = _CachedModel(draft_model, start=length - 1) if use_cfg else None
+
+    def column(value):
+        return torch.tensor([[value]], dtype=torch.float32, device=device)
+    guidance, penalty = column(r.guidance_scale), column(r.repetition_penalty)
+    temperature, top_p = column(r.temperature), column(r.top_p)
+    vocab_size = getattr(model, "_orig_mod", model).config.vocab_size
+
+    def probs(logits, uncond_logits, seq, rows):
+        # row j predicts position seq.shape[-1] - rows + j; padding repeats the last prompt token
+        if logits.shape[-1] != vocab_size:
+            # the draft's embedding matrix may be padded differently
+            logits = F.pad(logits[:, :vocab_size], (0, max(0, vocab_size - logits.shape[-1])), value=-float("inf"))
+            if uncond_logits is not None:
+                uncond_logits = F.pad(uncond_logits[:, :vocab_size], (0, max(0, vocab_size - uncond_logits.shape[-1])),
+                                      value=-float("inf"))
+        first = seq.shape[-1] - rows + 1
+        seen = seq.expand(rows, -1).clone()
+        positions = torch.arange(seq.shape[-1], device=device)
+        seen[positions >= first + torch.arange(rows, device=device).unsqueeze(1)] = prompt[-1]
+        step = first - length + torch.arange(rows, device=device)
+        mask = framing.mask(logits, step, r.min_new_tokens, r.max_new_tokens)
+        return _sampling_probs(logits, uncond_logits, seen, mask, guidance, penalty, temperature, top_p)
+
+    seq = prompt
+    stats = {"proposed": 0, "accepted": 0, "target_passes": 0}
+    start = time.perf_counter()
+    prefill_seconds = None
+    while True:
+        n_new = seq.shape[-1] - length
+        n_draft = min(draft_tokens, r.max_new_tokens - n_new - 1)
+        proposal, q = seq, []
+        for _ in range(n_draft):
+            q.append(probs(draft.logits(proposal), draft_uncond.logits(proposal) if use_cfg else None, proposal, 1)[0])
+            proposal = torch.cat([proposal, torch.multinomial(q[-1], 1, generator=r.generator)])
+        rows = n_draft + 1
+        p = probs(target.logits(proposal, rows), target_uncond.logits(proposal, rows) if use_cfg else None, proposal, rows)
+        stats["target_passes"] += 1
+        stats["proposed"] += n_draft
+
+        accepted, next_token = 0, None
+        for j in range(n_draft):
+            x = proposal[seq.shape[-1] + j]
+            if torch.rand(1, device=device, generator=r.generator) * q[j][x] < p[j, x]:
+                accepted += 1
+                if x == eoa_id:
+                    break
+                continue
+            residual = (p[j] - q[j]).clamp(min=0)
+            next_token = torch.multinomial(residual if residual.sum() > 0 else p[j], 1, generator=r.generator)
+            break
+        else:
+            next_token = torch.multinomial(p[n_draft], 1, generator=r.generator)
+        stats["accepted"] += accepted
+
+        seq = proposal[:seq.shape[-1] + accepted]
+        for cached in (target, target_uncond, draft, draft_uncond):
+            if cached is not None:
+                cached.rewind(seq.shape[-1])
+        if next_token is not None:
+            seq = torch.cat([seq, next_token])
+        if prefill_seconds is None:
+            _synchronize(device)
+            prefill_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+        if seq[-1] == eoa_id or seq.shape[-1] - length >= r.max_new_tokens:
+            break
+
+    if r.keep_cache:
+        # every token but the last one has been fed
+        target.rewind(seq.shape[-1] - 1)
+        r.cached_len = target.fed
+        r.past_key_values = _cache_layers(target.cache)
+    else:
+        r.cached_len = 0
+    r.draft_stats = stats
+    _synchronize(device)
+    r.timings = {"prefill": prefill_seconds, "decode": time.perf_counter() - start,
+                 "prefill_tokens": length - n_cached, "new_tokens": seq.shape[-1] - length}
+    return seq
+
+
+class Stage1Batcher:
+    """Groups stage-1 segments of concurrently running songs into shared forward passes.
+
+    Jobs call generate() from their own threads. A dispatcher thread collects
+    requests for up to `max_wait` seconds, takes the oldest one plus up to
+    `max_batch_size - 1` others at the same segment index and samples them
+    together. With max_batch_size=1 requests run directly in the caller's thread.
+
+    With a `draft_model`, segments are sampled speculatively instead, one song
+    per call in the caller's thread (sample_segment_speculative): that lowers
+    a song's latency rather than raising throughput. `draft_stats` totals the
+    proposed and accepted draft tokens over all segments.
+    """
+
+    def __init__(self, model, framing, max_batch_size=1, max_wait=0.05, draft_model=None, draft_tokens=4):
+        self.model = model
+        self.framing = framing
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.draft_model = draft_model
+        self.draft_tokens = draft_tokens
+        self.draft_stats = {"proposed": 0, "accepted": 0, "target_passes": 0}
+        self._pending = []
+        self._cond = threading.Condition()
+        if max_batch_size > 1 and draft_model is None:
+            threading.Thread(target=self._dispatch, name="stage1-batcher", daemon=True).start()
+
+    def generate(self, request):
+        if self.draft_model is not None:
+            output = sample_segment_speculative(self.model, self.draft_model, request, self.framing, self.draft_tokens)
+            with self._cond:
+                for key, value in request.draft_stats.items():
+                    self.draft_stats[key] += value
+            return output
+        if self.max_batch_size <= 1:
+            return sample_segments(self.model, [request], self.framing)[0]
+        with self._cond:
+            self._pending.append(request)
+            self._cond.notify_all()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.output
+
+    def _next_batch(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending)
+            deadline = time.monotonic() + self.max_wait
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            segment_idx = self._pending[0].segment_idx
+            batch = [r for r in self._pending if r.segment_idx == segment_idx][:self.max_batch_size]
+            self._pending = [r for r in self._pending if r not in batch]
+        return batch
+
+    def _dispatch(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                outputs = sample_segments(self.model, batch, self.framing)
+                for request, output in zip(batch, outputs):
+                    request.output = output
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            finally:
+                for request in batch:
+                    request.done.set()
@@ -0,0 +1,63 @@
+import queue
+import threading
+from contextlib import nullcontext
+
+import torch
+
+_CLOSE = object()
+
+
+class PipelineStage:
+    """A worker thread that hands the items put() to it, in order, to `fn`.
+
+    Stages are chained by having one stage's `fn` put its results into the
+    next stage, so each of them works on its own item while the producer goes
+    on with the next one. On a CUDA `device` the worker issues its kernels on
+    a stream of its own, so they can overlap those of the other stages.
+
+    A failure stops the stage: the rest of its items are dropped, and the
+    error is raised again by the next put() and by join().
+    """
+
+    def __init__(self, name, fn, device=None):
+        self.fn = fn
+        self.error = None
+        self._drop = False
+        self._queue = queue.Queue()
+        device = torch.device(device) if device is not None else None
+        self._stream = torch.cuda.Stream(device) if device is not None and device.type == "cuda" else None
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def put(self, item):
+        self._raise()
+        self._queue.put(item)
+
+    def close(self, drop=False):
+        """No more items; join() returns once the queued ones are done (or, with `drop`, skipped)."""
+        if drop:
+            self._drop = True
+        self._queue.put(_CLOSE)
+
+    def join(self):
+        self._thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        with torch.cuda.stream(self._stream) if self._stream is not None else nullcontext():
+            while True:
+                item = self._queue.get()
+                if item is _CLOSE:
+                    break
+                if self.error is not None or self._drop:
+                    continue
+                try:
+                    self.fn(item)
+                except BaseException as e:
+                    self.error = e
+        if self._stream is not None:
+            self._stream.synchronize()
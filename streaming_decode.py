@@ -0,0 +1,176 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# xcodec frames per second of audio
+CODEC_FRAME_RATE = 50
+
+
+class ChunkedDecoder:
+    """Decodes a growing (n_codebooks, n_frames) code sequence in overlapping windows.
+
+    Codes arrive through push(). Whenever `chunk_frames` new frames are
+    available they are decoded together with up to `context_frames` earlier
+    frames, and the start of the new audio is crossfaded over `overlap_frames`
+    with the held-back end of the previous window to hide the seam. Emitted
+    audio is final, so only about one window of codes and audio is held no
+    matter how long the track gets. `decode(codes)` returns (1, samples) audio
+    at `samples_per_frame` samples per frame.
+    """
+
+    def __init__(self, decode, samples_per_frame, chunk_frames=300, overlap_frames=25, context_frames=50):
+        if chunk_frames <= overlap_frames:
+            raise ValueError("chunk_frames must be larger than overlap_frames")
+        self.decode = decode
+        self.samples_per_frame = samples_per_frame
+        self.chunk_frames = chunk_frames
+        self.overlap_frames = overlap_frames
+        self.context_frames = context_frames
+        self._codes = None  # codes from frame self._base on
+        self._base = 0
+        self._end = 0       # frames pushed
+        self._pos = 0       # frames decoded, emitted or held in self._tail
+        self._tail = None   # audio of the last decoded frames, not emitted yet
+
+    def push(self, codes):
+        """Add frames; returns the list of audio chunks that became final."""
+        self._codes = codes if self._codes is None else np.concatenate([self._codes, codes], axis=1)
+        self._end += codes.shape[1]
+        chunks = []
+        while self._end - self._pos >= self.chunk_frames:
+            chunks.append(self._decode_until(self._pos + self.chunk_frames, final=False))
+        return chunks
+
+    def flush(self):
+        """Decode whatever is left; returns the list of remaining audio chunks."""
+        if self._end == self._pos and self._tail is None:
+            return []
+        return [self._decode_until(self._end, final=True)]
+
+    def _decode_until(self, end, final):
+        spf = self.samples_per_frame
+        overlap = 0 if self._tail is None else self._tail.shape[-1] // spf
+        if end > self._pos:
+            start = max(0, self._pos - overlap - self.context_frames)
+            wav = self.decode(self._codes[:, start - self._base:end - self._base])
+            needed = (end - start) * spf
+            wav = F.pad(wav[..., :needed], (0, max(0, needed - wav.shape[-1])))
+            # frames [pos - overlap, end)
+            audio = wav[..., (self._pos - overlap - start) * spf:].clone()
+        else:
+            audio = self._tail.clone()
+        if overlap:
+            n = overlap * spf
+            fade = torch.linspace(0, 1, n, dtype=audio.dtype)
+            audio[..., :n] = self._tail * (1 - fade) + audio[..., :n] * fade
+        held = 0 if final else min(self.overlap_frames, end - self._pos) * spf
+        self._pos = end
+        self._tail = audio[..., audio.shape[-1] - held:] if held else None
+        keep_from = max(0, self._pos - self.overlap_frames - self.context_frames)
+        self._codes = self._codes[:, keep_from - self._base:]
+        self._base = keep_from
+        return audio[..., :audio.shape[-1] - held]
+
+
+class StreamMixer:
+    """Sums several tracks' audio chunks as soon as every track has reached them."""
+
+    def __init__(self, n_tracks):
+        self._pending = [None] * n_tracks
+
+    def add(self, track, chunk):
+        """Returns the newly mixable audio, or None."""
+        pending = self._pending[track]
+        self._pending[track] = chunk if pending is None else torch.cat([pending, chunk], dim=-1)
+        if any(p is None for p in self._pending):
+            return None
+        n = min(p.shape[-1] for p in self._pending)
+        if n == 0:
+            return None
+        mixed = sum(p[..., :n] for p in self._pending)
+        self._pending = [p[..., n:] for p in self._pending]
+        return mixed
+
+    @property
+    def leftover(self):
+        """Samples per track that never got mixed; non-zero if the tracks' lengths differ."""
+        return [0 if p is None else p.shape[-1] for p in self._pending]
+
+
+class SongDecoder:
+    """Streams the stage-2 codes of a song's tracks through codec and vocoder decoders.
+
+    push(track, codes) is called as stage 2 completes chunks. The 44.1 kHz
+    vocoder mix is handed to `sink` (clamped to +-`limit`) chunk by chunk as
+    soon as all tracks have reached it. finish() returns the waveforms the
+    output files are written from.
+    """
+
+    def __init__(self, recons_decoders, vocoder_decoders, sink=None, progress=None,
+                 total_frames=0, keep_stems=False, limit=0.99):
+        self.recons_decoders = recons_decoders
+        self.vocoder_decoders = vocoder_decoders
+        self.sink = sink
+        self.progress = progress
+        self.total_frames = total_frames
+        self.keep_stems = keep_stems
+        self.limit = limit
+        n_tracks = len(vocoder_decoders)
+        self._recons = [[] for _ in range(n_tracks)]
+        self._recons_mix = StreamMixer(n_tracks)
+        self._recons_mixed = []
+        self._vocoder = [[] for _ in range(n_tracks)]
+        self._vocoder_mix = StreamMixer(n_tracks)
+        self._vocoder_mixed = []
+        self._mixed_samples = 0
+
+    def push(self, track, codes):
+        for chunk in self.recons_decoders[track].push(codes):
+            self._add_recons(track, chunk)
+        for chunk in self.vocoder_decoders[track].push(codes):
+            self._add_vocoder(track, chunk)
+
+    def _add_recons(self, track, chunk):
+        # limited like the reconstructions used to be when saved before mixing
+        chunk = chunk.clamp(-self.limit, self.limit)
+        if self.keep_stems:
+            self._recons[track].append(chunk)
+        mixed = self._recons_mix.add(track, chunk)
+        if mixed is not None:
+            self._recons_mixed.append(mixed)
+
+    def _add_vocoder(self, track, chunk):
+        if self.keep_stems:
+            self._vocoder[track].append(chunk)
+        mixed = self._vocoder_mix.add(track, chunk)
+        if mixed is None:
+            return
+        self._vocoder_mixed.append(mixed)
+        if self.sink is not None:
+            self.sink(mixed.clamp(-self.limit, self.limit))
+        self._mixed_samples += mixed.shape[-1]
+        if self.progress is not None:
+            samples_per_frame = self.vocoder_decoders[track].samples_per_frame
+            self.progress("vocoder", self._mixed_samples // samples_per_frame // CODEC_FRAME_RATE,
+                          self.total_frames // CODEC_FRAME_RATE)
+
+    def finish(self):
+        for track, decoder in enumerate(self.recons_decoders):
+            for chunk in decoder.flush():
+                self._add_recons(track, chunk)
+        for track, decoder in enumerate(self.vocoder_decoders):
+            for chunk in decoder.flush():
+                self._add_vocoder(track, chunk)
+
+        def cat(chunks):
+            return torch.cat(chunks, dim=-1) if chunks else None
+        audio = {
+            "recons": [cat(chunks) for chunks in self._recons],
+            "recons_mix": cat(self._recons_mixed),
+            "vocoder": [cat(chunks) for chunks in self._vocoder],
+            "vocoder_mix": cat(self._vocoder_mixed),
+        }
+        if any(self._vocoder_mix.leftover):
+            print(f"mix failed! unmatched samples per track: {self._vocoder_mix.leftover}")
+            audio["vocoder_mix"] = None
+        return audio
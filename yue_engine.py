@@ -0,0 +1,1232 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xcodec_mini_infer'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xcodec_mini_infer', 'descriptaudiocodec'))
+import re
+import time
+import importlib.util
+import random
+import uuid
+import copy
+import tempfile
+import functools
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+import numpy as np
+import torch
+import torchaudio
+from torchaudio.transforms import Resample
+from einops import rearrange
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from omegaconf import OmegaConf
+from codecmanipulator import CodecManipulator
+from mmtokenizer import _MMSentencePieceTokenizer
+from models.soundstream_hubert_new import SoundStream
+from vocoder import build_codec_model
+from result_cache import ResultCache, cache_key, file_digest
+from residency import ResidencyManager
+from checkpoints import JobCheckpoint, prune_checkpoints
+from stage1_decoding import CodecFraming, SegmentRequest, Stage1Batcher, last_logits_kwargs
+from streaming_decode import CODEC_FRAME_RATE, ChunkedDecoder, SongDecoder
+from stage_pipeline import PipelineStage
+import metrics
+
+from yue_infer import (
+    DECODE_MODELS, FINAL_OUTPUT_NAMES, JOB_PARAMS, STAGE1_TEMPERATURE, STAGE1_TOP_P,
+    STAGE2_CHUNK_FRAMES, STAGE2_MODELS, STAGE_TRACK_NAMES, check_args,
+)
+
+
+def configure_compile_cache(root):
+    """Make torch.compile reuse compiled graphs and kernels across processes.
+
+    Inductor's FX-graph and Triton caches go to a persistent directory under
+    `root`, split by torch version and GPU model. Inside it inductor keys each
+    entry on the traced graph, so on the model code, dtypes and input shapes,
+    and automatic dynamic shapes keep the number of shape variants small. A
+    restarted worker then loads kernels instead of recompiling them.
+    """
+    device = torch.cuda.get_device_name(0) if torch.cuda.is_available() else "cpu"
+    path = os.path.abspath(os.path.join(root, re.sub(r"[^\w.-]+", "_", f"torch-{torch.__version__}-{device}")))
+    os.makedirs(path, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", path)
+    os.environ.setdefault("TRITON_CACHE_DIR", os.path.join(path, "triton"))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        pass
+    return path
+
+def resolve_device(name, cuda_idx=0):
+    """torch.device for a --device value ('auto', 'cuda' or 'cpu')."""
+    if name == "auto":
+        name = "cuda" if torch.cuda.is_available() else "cpu"
+    if name == "cuda":
+        if not torch.cuda.is_available():
+            raise RuntimeError("--device cuda was requested but no GPU is available")
+        return torch.device(f"cuda:{cuda_idx}")
+    return torch.device("cpu")
+
+def attention_implementation(device):
+    """flash_attention_2 on a GPU when flash-attn is installed, PyTorch SDPA otherwise."""
+    if device.type == "cuda" and importlib.util.find_spec("flash_attn") is not None:
+        return "flash_attention_2"
+    return "sdpa"
+
+def configure_cpu_threads(num_threads=0, interop_threads=0):
+    """Per-process CPU thread pools, so several workers on one node do not oversubscribe the cores."""
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if interop_threads > 0:
+        try:
+            # only allowed before the first parallel op of the process
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            print(f"Could not set inter-op threads: {e}")
+
+def quantize_int8(module):
+    """int8 dynamic quantization of every nn.Linear (weights int8, activations quantized per batch).
+
+    Only applies to CPU inference. Convolutions, embeddings and norms stay in
+    float32, which is where the codec and the Vocos decoders spend little of
+    their parameter budget but most of their precision.
+    """
+    try:
+        from torch.ao.quantization import quantize_dynamic
+    except ImportError:
+        from torch.quantization import quantize_dynamic
+    return quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def seed_everything(seed=42): 
+    random.seed(seed) 
+    np.random.seed(seed) 
+    torch.manual_seed(seed) 
+    torch.cuda.manual_seed_all(seed) 
+    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.benchmark = False
+
+
+class Stage2Decoder:
+    """Greedy stage-2 teacher-forcing decoder that keeps the KV cache across frames.
+
+    For every codec frame the teacher-forced codebook-0 token is appended and the
+    7 remaining codebook tokens are decoded greedily, only ever feeding the tokens
+    the cache has not seen yet. This produces the same tokens as calling
+    `model.generate(max_new_tokens=7)` on the whole growing prefix per frame
+    (restricted to [allowed_start, allowed_end)), at linear instead of quadratic
+    cost in the chunk length.
+    """
+
+    def __init__(self, model, allowed_start, allowed_end, vocab_size, n_generated=7):
+        self.model = model
+        self.allowed_start = allowed_start
+        self.allowed_end = allowed_end
+        self.vocab_size = vocab_size
+        self.n_generated = n_generated
+        self._mask = None
+        # Only materialise last-position logits during prefill when the model supports it
+        self._last_logits_kwargs = last_logits_kwargs(model)
+
+    def _block_mask(self, logits):
+        # Blocks [0, allowed_start) and [allowed_end, vocab_size), as the old BlockTokenRangeProcessor pair did
+        if self._mask is None or self._mask.shape[-1] != logits.shape[-1] or self._mask.device != logits.device:
+            mask = torch.zeros(logits.shape[-1], dtype=logits.dtype, device=logits.device)
+            mask[:self.allowed_start] = -float("inf")
+            mask[self.allowed_end:self.vocab_size] = -float("inf")
+            self._mask = mask
+        return self._mask
+
+    def _step(self, input_ids, past_key_values):
+        out = self.model(input_ids=input_ids, past_key_values=past_key_values, use_cache=True, **self._last_logits_kwargs)
+        logits = out.logits[:, -1, :].float()
+        next_tokens = torch.argmax(logits + self._block_mask(logits), dim=-1, keepdim=True)
+        return next_tokens, out.past_key_values
+
+    @torch.no_grad()
+    def decode(self, prompt_ids, codec_ids):
+        """prompt_ids: (B, L) prompt, codec_ids: (B, T) codebook-0 tokens.
+        Returns (B, L + 8*T): the prompt followed by [cb0, 7 generated] per frame."""
+        prompt_ids = prompt_ids.long()
+        codec_ids = codec_ids.long()
+        past_key_values = None
+        pending = prompt_ids
+        frames = [prompt_ids]
+        for frames_idx in range(codec_ids.shape[1]):
+            cb0 = codec_ids[:, frames_idx:frames_idx+1]
+            pending = torch.cat([pending, cb0], dim=1)
+            frames.append(cb0)
+            for _ in range(self.n_generated):
+                pending, past_key_values = self._step(pending, past_key_values)
+                frames.append(pending)
+        return torch.cat(frames, dim=1)
+
+
+def plan_stage2_batches(track_lengths, batch_size, chunk_frames=300):
+    """Pack the 6 s chunks of several tracks, and their ragged tails, into shared stage-2 batches.
+
+    Chunks are ordered by position first and track second, so chunk k of the
+    vocal and instrumental tracks land in the same or neighbouring batches.
+    The teacher-forcing loop runs a batch in lockstep, so one batch only holds
+    chunks of one length; the memory budget is batch_size * chunk_frames frames
+    per batch, which lets the short tails of all tracks go through together.
+    Returns batches as lists of (track_idx, start_frame, end_frame).
+    """
+    budget = batch_size * chunk_frames
+    full_chunks = []
+    for k in range(max(track_lengths, default=0) // chunk_frames):
+        for track, length in enumerate(track_lengths):
+            if (k + 1) * chunk_frames <= length:
+                full_chunks.append((track, k * chunk_frames, (k + 1) * chunk_frames))
+    tails = {}
+    for track, length in enumerate(track_lengths):
+        tail = length % chunk_frames
+        if tail:
+            tails.setdefault(tail, []).append((track, length - tail, length))
+
+    batches = []
+    for group in [full_chunks] + list(tails.values()):
+        if not group:
+            continue
+        per_batch = max(1, budget // (group[0][2] - group[0][1]))
+        batches += [group[i:i + per_batch] for i in range(0, len(group), per_batch)]
+    return batches
+
+def fix_invalid_codes(codes, codebook_size=1024):
+    """Replace codes outside [0, codebook_size) with their row's most frequent value, in place.
+
+    Matches the original per-element loop exactly: the mode is taken over the
+    whole row (invalid values included), ties go to the value that occurs first,
+    and it is computed once per row with a single bincount. Returns the number
+    of codes replaced.
+    """
+    invalid = (codes < 0) | (codes >= codebook_size)
+    for i in np.flatnonzero(invalid.any(axis=1)):
+        row = codes[i].astype(np.int64)
+        shifted = row - row.min()
+        counts = np.bincount(shifted)
+        modes = np.flatnonzero(counts == counts.max())
+        codes[i, invalid[i]] = row[np.argmax(np.isin(shifted, modes))]
+    return int(invalid.sum())
+
+@functools.lru_cache(maxsize=None)
+def resampler(orig_freq, new_freq):
+    """One Resample per rate pair; its sinc kernel is built once and reused."""
+    return Resample(orig_freq=orig_freq, new_freq=new_freq)
+
+def load_audio_mono(filepath, sampling_rate=16000, start_time=0.0, end_time=None):
+    audio, sr = torchaudio.load(filepath)
+    # Crop to [start_time, end_time) seconds before anything else is computed on it
+    audio = audio[:, round(start_time * sr):None if end_time is None else round(end_time * sr)]
+    # Convert to mono
+    audio = torch.mean(audio, dim=0, keepdim=True)
+    # Resample if needed
+    if sr != sampling_rate:
+        audio = resampler(sr, sampling_rate)(audio)
+    return audio
+
+@functools.lru_cache(maxsize=256)
+def _file_digest(path, size, mtime_ns):
+    return file_digest(path)
+
+def prompt_digest(path):
+    """Content hash of a prompt file, rehashed only when its size or mtime changes."""
+    st = os.stat(path)
+    return _file_digest(os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+def encode_audio(codec_model, audio_prompt, device, target_bw=0.5):
+    if len(audio_prompt.shape) < 3:
+        audio_prompt.unsqueeze_(0)
+    with torch.no_grad():
+        raw_codes = codec_model.encode(audio_prompt.to(device), target_bw=target_bw)
+    raw_codes = raw_codes.transpose(0, 1)
+    raw_codes = raw_codes.cpu().numpy().astype(np.int16)
+    return raw_codes
+
+def no_progress(stage, done, total):
+    pass
+
+# Codec frames of context encoded on each side of a cropped prompt range
+PROMPT_CONTEXT_FRAMES = CODEC_FRAME_RATE
+# Encoded prompt ranges kept in memory
+PROMPT_CACHE_ENTRIES = 256
+
+def split_lyrics(lyrics):
+    pattern = r"\[(\w+)\](.*?)(?=\[|\Z)"
+    segments = re.findall(pattern, lyrics, re.DOTALL)
+    structured_lyrics = [f"[{seg[0]}]\n{seg[1].strip()}\n\n" for seg in segments]
+    return structured_lyrics
+
+def limit_audio(wav: torch.Tensor, rescale: bool = False, limit: float = 0.99):
+    max_val = wav.abs().max()
+    return wav * min(limit / max_val, 1) if rescale else wav.clamp(-limit, limit)
+
+# convert audio tokens to audio
+def save_audio(wav: torch.Tensor, path, sample_rate: int, rescale: bool = False):
+    folder_path = os.path.dirname(path)
+    if not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+    wav = limit_audio(wav, rescale)
+    torchaudio.save(str(path), wav, sample_rate=sample_rate, encoding='PCM_S', bits_per_sample=16)
+
+def replace_low_freq(low, low_sr, high, high_sr, cutoff_freq=5500.0, eps=1e-10):
+    """In-memory counterpart of post_process_audio.replace_low_freq_with_energy_matched.
+
+    Resamples `low` (the 16 kHz codec reconstruction) to `high_sr`, scales its
+    band below `cutoff_freq` to the energy of the same band in `high` (the
+    vocoder output) and substitutes it there. Both are (channels, samples).
+    """
+    low = torchaudio.functional.resample(low, low_sr, high_sr)
+    n = min(low.shape[-1], high.shape[-1])
+    low_spec = torch.fft.rfft(low[..., :n].double())
+    high_spec = torch.fft.rfft(high[..., :n].double())
+    band = torch.fft.rfftfreq(n, d=1.0 / high_sr) < cutoff_freq
+    scale = torch.sqrt(high_spec[..., band].abs().pow(2).sum() / (low_spec[..., band].abs().pow(2).sum() + eps))
+    high_spec[..., band] = low_spec[..., band] * scale
+    return torch.fft.irfft(high_spec, n=n).float()
+
+
+class _SongRun:
+    """State of one song on its way through YuEEngine.generate / generate_many."""
+
+    def __init__(self, job=None, lyrics=None, genre=None, stage1_output_set=None, stage2_output_set=None, outputs=None):
+        self.job = job
+        self.lyrics = lyrics
+        self.genre = genre
+        self.stage1_output_set = stage1_output_set
+        self.stage2_output_set = stage2_output_set
+        self.outputs = outputs
+        self.keys = {}
+        self.metrics = metrics.JobMetrics()
+        self.checkpoint = None  # JobCheckpoint with --checkpoint_dir
+        self.keys_in_use = ()   # its directories, kept while the song runs
+        self.stage1_tracks = None
+        self.stage2_tracks = None
+        self.decoded = None     # SongDecoder.finish() output restored from a checkpoint
+        self.writes = []        # background writes to wait for
+        self.timings = {}
+        self.error = None
+        self.finished = False
+        self.started = time.perf_counter()
+
+    @classmethod
+    def failed(cls, error):
+        song = cls()
+        song.fail(error)
+        return song
+
+    def fail(self, error):
+        self.error = str(error)
+        self.outputs = None
+        self.finished = True
+
+
+class YuEEngine:
+    """Loads the stage-1/stage-2 LMs, the xcodec model and both Vocos decoders once
+    and keeps them in memory, so each generate() call only pays for inference.
+
+    Which of them sit on the GPU is decided by a ResidencyManager: each stage
+    marks the models it uses, and switching stages costs a host-to-device copy
+    of the weights that are not resident, never a reload.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        # stage 1 runs on self.device; stage 2, the codec and the vocoders on self.stage2_device
+        self.device = resolve_device(args.device, args.cuda_idx)
+        self.stage2_device = resolve_device(args.stage2_device or args.device, args.cuda_idx)
+        if "cpu" in (self.device.type, self.stage2_device.type):
+            configure_cpu_threads(args.cpu_threads, args.cpu_interop_threads)
+        # seconds spent in each loading phase (see benchmarks/bench_startup.py)
+        self.startup_timings = {}
+        if args.compile_cache_dir and not args.disable_compile:
+            configure_compile_cache(args.compile_cache_dir)
+        # generate() may run concurrently from several job threads; models in use
+        # by any of them stay on the GPU. Models that run on the CPU are never paged.
+        gpu = self.device if self.device.type == "cuda" else self.stage2_device
+        self.residency = ResidencyManager(
+            gpu,
+            device_budget=int(args.gpu_weight_budget_gb * 1024**3),
+            host_budget=int(args.host_weight_budget_gb * 1024**3),
+            spill_dir=args.weight_spill_dir,
+        )
+        # load tokenizer and model
+        with self._phase("tokenizer"):
+            self.mmtokenizer = _MMSentencePieceTokenizer("./mm_tokenizer_v0.2_hf/tokenizer.model")
+        self.codectool = CodecManipulator("xcodec", 0, 1)
+        self.codectool_stage2 = CodecManipulator("xcodec", 0, 8)
+        self.model = self.draft_model = self.stage1_batcher = None
+        # what the cache keys say produced the stage-1 tokens; the same for a decode-only engine
+        self.stage1_model_id = args.stage1_model_id or args.stage1_model
+        if not self.stage1_model_id:
+            raise ValueError("An engine without --stage1_model needs --stage1_model_id to find cached stage-1 tokens")
+        # without a stage-1 model the engine only runs stage 2 and decoding, on cached stage-1 tokens
+        if args.stage1_model:
+            with self._phase("stage1_weights"):
+                self.model = self._load_lm("stage1", args.stage1_model, self.device)
+            self.draft_model = None
+            if args.draft_model:
+                with self._phase("draft_weights"):
+                    self.draft_model = self._load_lm("draft", args.draft_model, self.device)
+            # stage 1 may only sample codebook-0 xcodec tokens, in vocal/instrumental pairs, closed by eoa
+            codec_start = self.codectool.global_offset
+            framing = CodecFraming(self.mmtokenizer.eoa, codec_start, codec_start + self.codectool.codebook_size)
+            self.stage1_batcher = Stage1Batcher(self.model, framing, args.stage1_batch_size, args.stage1_batch_wait,
+                                                draft_model=self.draft_model, draft_tokens=args.draft_tokens)
+        with self._phase("codec_weights"):
+            self.codec_model = self._prepare(self._load_codec().eval())
+            self._register("codec", self.codec_model)
+        with self._phase("stage2_weights"):
+            self.model_stage2 = self._load_lm("stage2", args.stage2_model, self.stage2_device)
+        # vocoder to upsample audios
+        with self._phase("vocoder_weights"):
+            self.vocal_decoder, self.inst_decoder = self._load_vocoders()
+            self.vocal_decoder = self._prepare(self.vocal_decoder.cpu().eval())
+            self.inst_decoder = self._prepare(self.inst_decoder.cpu().eval())
+            self._register("vocal_decoder", self.vocal_decoder)
+            self._register("inst_decoder", self.inst_decoder)
+        # stages hand arrays to each other; files are only written on this side channel
+        self._writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="yue-writer")
+        self.cache = ResultCache(args.cache_dir, int(args.cache_max_gb * 1024**3)) if args.cache_dir else None
+        self._prompt_codes = OrderedDict()    # key -> codes of an encoded prompt range, least recently used first
+        self._prompt_lock = threading.Lock()
+        self._active_checkpoints = Counter()    # checkpoint dirs of the songs running now, kept by pruning
+        self._checkpoint_lock = threading.Lock()
+
+    @contextmanager
+    def _phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_timings[name] = time.perf_counter() - start
+
+    def _load_codec(self):
+        """The xcodec model, on the CPU."""
+        model_config = OmegaConf.load(self.args.basic_model_config)
+        codec_model = eval(model_config.generator.name)(**model_config.generator.config)
+        try:
+            # memory-mapped: tensors are paged in as load_state_dict copies them
+            parameter_dict = torch.load(self.args.resume_path, map_location='cpu', weights_only=False, mmap=True)
+        except RuntimeError:
+            # legacy (non-zip) checkpoints cannot be memory-mapped
+            parameter_dict = torch.load(self.args.resume_path, map_location='cpu', weights_only=False)
+        codec_model.load_state_dict(parameter_dict['codec_model'])
+        return codec_model
+
+    def _load_vocoders(self):
+        """The vocal and instrumental Vocos decoders."""
+        return build_codec_model(self.args.config_path, self.args.vocal_decoder_path, self.args.inst_decoder_path)
+
+    def _load_lm(self, name, name_or_path, device):
+        # safetensors checkpoints are memory-mapped by from_pretrained
+        model = AutoModelForCausalLM.from_pretrained(
+            name_or_path, 
+            # bf16 has no fast CPU kernels; float32 there (and int8 for stage 2, see _prepare)
+            torch_dtype=torch.bfloat16 if device.type == "cuda" else torch.float32,
+            attn_implementation=attention_implementation(device), # To enable flashattn, you have to install flash-attn
+            # device_map="auto",
+            )
+        # weights move to the gpu when a stage uses them
+        model.eval()
+        if name not in ("stage1", "draft"):
+            model = self._prepare(model)
+        self._register(name, model)
+
+        # inductor does not compile dynamically quantized linears; the CPU profile runs eagerly
+        if torch.__version__ >= "2.0.0" and not self.args.disable_compile and device.type == "cuda":
+            model = torch.compile(model)
+        return model
+
+    def _prepare(self, module):
+        """Quantize a stage-2/codec/vocoder model to int8 when those stages run on the CPU."""
+        if self.stage2_device.type == "cpu" and not self.args.disable_int8:
+            return quantize_int8(module)
+        return module
+
+    def _register(self, name, module):
+        device = self.device if name in ("stage1", "draft") else self.stage2_device
+        self.residency.register(name, module, pinned=self.args.disable_offload_model, static=device.type == "cpu")
+
+    @property
+    def stage2_profile(self):
+        """Numerics of stage 2 and the decoders; part of the result cache keys."""
+        if self.stage2_device.type == "cuda":
+            return "cuda-bf16"
+        return "cpu-fp32" if self.args.disable_int8 else "cpu-int8"
+
+    @torch.no_grad()
+    def warmup(self):
+        """Run both LMs once at a few prompt lengths plus a cached decoding step, so
+        torch.compile compiles (or loads from --compile_cache_dir) at startup
+        rather than during the first request."""
+        for name, model, device in (("stage1", self.model, self.device), ("draft", self.draft_model, self.device),
+                                    ("stage2", self.model_stage2, self.stage2_device)):
+            if model is None:
+                continue
+            with self._phase(f"{name}_warmup"), self.residency.use(name):
+                # two lengths, so the sequence dimension is compiled as dynamic right away
+                for length in (16, 32):
+                    input_ids = torch.full((1, length), self.mmtokenizer.soa, dtype=torch.long, device=device)
+                    out = model(input_ids=input_ids, use_cache=True)
+                    model(input_ids=input_ids[:, -1:], past_key_values=out.past_key_values, use_cache=True)
+
+    def job_args(self, params=None):
+        params = dict(params or {})
+        unknown = set(params) - set(JOB_PARAMS)
+        if unknown:
+            raise ValueError(f"Unsupported generation params: {sorted(unknown)}")
+        job = copy.copy(self.args)
+        for key, value in params.items():
+            setattr(job, key, value)
+        check_args(job)
+        return job
+
+    def cache_keys(self, job, lyrics, genre):
+        """Keys of the stage-1, stage-2 and final-mix cache entries for one job.
+
+        Each level hashes the key of the level below plus whatever only that level
+        depends on, so e.g. a different --rescale still hits the stage-2 entry.
+        """
+        prompt = None
+        if job.use_dual_tracks_prompt:
+            prompt = ["dual", prompt_digest(job.vocal_track_prompt_path), prompt_digest(job.instrumental_track_prompt_path),
+                      job.prompt_start_time, job.prompt_end_time, self.args.resume_path]
+        elif job.use_audio_prompt:
+            prompt = ["audio", prompt_digest(job.audio_prompt_path), job.prompt_start_time, job.prompt_end_time, self.args.resume_path]
+        # speculative sampling draws from the same distribution, but a seed gives a different song
+        draft = [self.args.draft_model, self.args.draft_tokens] if self.args.draft_model else []
+        stage1 = cache_key("stage1", self.stage1_model_id, lyrics, genre.strip(), job.seed, STAGE1_TOP_P, STAGE1_TEMPERATURE,
+                           job.repetition_penalty, job.max_new_tokens, job.run_n_segments, prompt, *draft)
+        # "chunk-repair": invalid codes are repaired per stage-2 chunk (entries repaired per track are not reused)
+        stage2 = cache_key("stage2", stage1, self.args.stage2_model, job.stage2_batch_size, self.stage2_profile, "chunk-repair")
+        final = cache_key("final", stage2, self.args.resume_path, self.args.config_path,
+                          self.args.vocal_decoder_path, self.args.inst_decoder_path, job.rescale)
+        return {"stage1": stage1, "stage2": stage2, "final": final}
+
+    def cached_outputs(self, lyrics, genre, params=None):
+        """Paths of a cached final mix for these inputs (inside the cache), or None."""
+        if self.cache is None:
+            return None
+        job = self.job_args(params)
+        return self.cache.get(self.cache_keys(job, lyrics, genre)["final"], FINAL_OUTPUT_NAMES.values())
+
+    @staticmethod
+    def track_paths(job, genres, directory, run_id):
+        name = f"{genres.strip().replace(' ', '-')}_tp{STAGE1_TOP_P}_T{STAGE1_TEMPERATURE}_rp{job.repetition_penalty}_maxtk{job.max_new_tokens}_{run_id}"
+        return [
+            os.path.join(directory, f"{name}_vtrack".replace('.', '@')+'.npy'),
+            os.path.join(directory, f"{name}_itrack".replace('.', '@')+'.npy'),
+        ]
+
+    def generate(self, lyrics, genre, params=None, progress=None, audio_sink=None):
+        """Run the full pipeline for one song and return the paths of its outputs.
+
+        `lyrics` and `genre` are the raw text that used to be read from
+        --lyrics_txt/--genre_txt; `params` overrides any of JOB_PARAMS.
+        `progress(stage, done, total)` is called as stage-1 segments, stage-2
+        batches and vocoder tracks complete.
+
+        Stages pass tokens and waveforms in memory. Only the vocoder and final
+        mixes are always written; stage tokens, codec reconstructions and stems
+        are written in the background with --keep_intermediate (stage tokens
+        also when the result cache needs them), overlapping later stages.
+
+        Audio is decoded in overlapping chunks while stage 2 runs; if given,
+        `audio_sink(wav)` receives the 44.1 kHz vocoder mix as (1, samples)
+        tensors as soon as each chunk is decoded.
+        """
+        progress = progress or no_progress
+        song = self._start_song(lyrics, genre, params)
+        if song.finished:
+            self._close_song(song)
+            return song.outputs
+        seed_everything(song.job.seed)
+        with metrics.tracking(song.metrics):
+            return self._generate(song, progress, audio_sink)
+
+    def _generate(self, song, progress, audio_sink):
+        try:
+            if song.decoded is None and song.stage1_tracks is None and song.stage2_tracks is None:
+                if self.args.pipeline_stages:
+                    self._run_pipelined(song, progress, audio_sink)
+                    return song.outputs
+                self._run_stage1(song, progress)
+            self._run_stage2([song], [progress], audio_sinks=[audio_sink])
+        finally:
+            self._close_song(song)
+        return song.outputs
+
+    def generate_many(self, songs, progress=None):
+        """Run several songs through the loaded models together; the batch mode.
+
+        `songs` is a list of (lyrics, genre, params). Their stage-1 segments are
+        sampled from concurrent threads, so --stage1_batch_size of them share
+        each forward pass, and the stage-2 chunks of all of them are packed into
+        shared stage-2 batches, with each song decoded as its codes arrive.
+        `progress(song_idx, stage, done, total)` reports per song; stage-2
+        progress is reported for every song of the group.
+
+        Returns one dict per song: "outputs" (as generate() returns, or None),
+        "error" (message or None) and "timings" (seconds per stage; the stage-2
+        and decode time is that of the whole group).
+        """
+        progress = progress or (lambda song_idx, stage, done, total: None)
+        runs = []
+        for idx, (lyrics, genre, params) in enumerate(songs):
+            try:
+                runs.append(self._start_song(lyrics, genre, params))
+            except Exception as e:
+                runs.append(_SongRun.failed(e))
+
+        def stage1(idx):
+            song = runs[idx]
+            if song.finished or song.decoded is not None or song.stage1_tracks is not None or song.stage2_tracks is not None:
+                return
+            try:
+                with metrics.tracking(song.metrics):
+                    self._run_stage1(song, lambda stage, done, total: progress(idx, stage, done, total))
+            except Exception as e:
+                song.fail(e)
+        with ThreadPoolExecutor(max_workers=max(1, self.args.stage1_batch_size), thread_name_prefix="yue-batch") as pool:
+            list(pool.map(stage1, range(len(runs))))
+
+        pending = [idx for idx, song in enumerate(runs) if not song.finished]
+        if pending:
+            try:
+                with metrics.tracking(*[runs[idx].metrics for idx in pending]):
+                    self._run_stage2([runs[idx] for idx in pending],
+                                     [lambda stage, done, total, idx=idx: progress(idx, stage, done, total) for idx in pending])
+            except Exception as e:
+                for idx in pending:
+                    runs[idx].fail(e)
+        for song in runs:
+            try:
+                self._close_song(song)
+            except Exception as e:
+                song.fail(e)
+        return [{"outputs": song.outputs, "error": song.error, "timings": song.timings} for song in runs]
+
+    def _start_song(self, lyrics, genre, params):
+        """Job arguments, output paths and cached or checkpointed stages of one song; finished on a final-mix cache hit."""
+        job = self.job_args(params)
+        keys = self.cache_keys(job, lyrics, genre) if self.cache is not None or self.args.checkpoint_dir else {}
+        stage1_output_dir = os.path.join(job.output_dir, f"stage1")
+        stage2_output_dir = stage1_output_dir.replace('stage1', 'stage2')
+        # checkpointed songs keep their file names across runs, so a resumed run overwrites the same outputs
+        run_id = keys["final"][:16] if self.args.checkpoint_dir else uuid.uuid4()
+        stage1_output_set = self.track_paths(job, genre, stage1_output_dir, run_id)
+        stage2_output_set = [os.path.join(stage2_output_dir, os.path.basename(path)) for path in stage1_output_set]
+        mix_name = os.path.basename(stage1_output_set[1]).replace('_itrack', '_mixed').replace('.npy', '.mp3')
+        outputs = {
+            "recons_mix": os.path.join(job.output_dir, "recons", "mix", mix_name) if job.keep_intermediate else None,
+            "vocoder_mix": os.path.join(job.output_dir, "vocoder", "mix", mix_name),
+            "final_mix": os.path.join(job.output_dir, mix_name),
+            "timings": os.path.join(job.output_dir, "timings.json"),
+        }
+        song = _SongRun(job, lyrics, genre, stage1_output_set, stage2_output_set, outputs)
+        song.metrics.info.update(device=self.device.type, stage2_profile=self.stage2_profile, seed=job.seed,
+                                 run_n_segments=job.run_n_segments, max_new_tokens=job.max_new_tokens)
+        song.keys = keys if self.cache is not None else {}
+        if song.keys and self.cache.restore(keys["final"], {FINAL_OUTPUT_NAMES[name]: outputs[name] for name in FINAL_OUTPUT_NAMES}):
+            print(f"Result cache hit: {keys['final']}")
+            song.outputs["recons_mix"] = None
+            song.finished = True
+            return song
+        if self.args.checkpoint_dir:
+            song.checkpoint = JobCheckpoint(self.args.checkpoint_dir, keys, resume=self.args.resume)
+            self._prune_checkpoints(song)
+            song.decoded = song.checkpoint.load("final", "decoded")
+            if song.decoded is not None:
+                print(f"Resuming from decoded stems: {keys['final']}")
+                return song
+        song.stage2_tracks = self._cached_tracks(song.keys.get("stage2")) or self._checkpointed_tracks(song, "stage2")
+        if song.stage2_tracks is None:
+            song.stage1_tracks = self._cached_tracks(song.keys.get("stage1")) or self._checkpointed_tracks(song, "stage1")
+        return song
+
+    def _run_stage1(self, song, progress, on_tracks=None):
+        start = time.perf_counter()
+        song.stage1_tracks = self.stage1_inference(song.job, song.lyrics, song.genre, progress, song.checkpoint, on_tracks)
+        song.timings["stage1"] = time.perf_counter() - start
+        if song.checkpoint is not None:
+            song.checkpoint.save("stage1", "tracks", song.stage1_tracks)
+        self._write_tracks(song.writes, song.job, song.stage1_output_set, song.stage1_tracks, song.keys.get("stage1"))
+
+    def _run_stage2(self, songs, progresses, audio_sinks=None):
+        """Stage 2 (where not cached) and the streaming decode of `songs`, then their mixes and output files.
+
+        `progresses` holds one progress callback per song; stage-2 batches are shared, so all of them get those.
+        """
+        start = time.perf_counter()
+        audio_sinks = audio_sinks or [None] * len(songs)
+
+        def stage2_progress(stage, done, total):
+            for progress in progresses:
+                progress(stage, done, total)
+        decoding = [song for song in songs if song.decoded is None]
+        todo = [song for song in decoding if song.stage2_tracks is None]
+        # stage 2 and the streaming decode interleave, so all their models stay on the gpu together
+        with self.residency.use(*(STAGE2_MODELS if todo else DECODE_MODELS if decoding else ())):
+            decoders = {}
+            for song, progress, sink in zip(songs, progresses, audio_sinks):
+                if song not in decoding:
+                    continue
+                tracks = song.stage2_tracks if song.stage2_tracks is not None else song.stage1_tracks
+                decoders[id(song)] = self.song_decoder(song.job, [track.shape[-1] for track in tracks], progress, sink)
+            if todo:
+                print("Stage 2 inference...")
+                # the [vocal, instrumental] tracks of all songs are packed into shared stage-2 batches
+                tracks = [track for song in todo for track in song.stage1_tracks]
+                n_tracks = len(todo[0].stage1_tracks)
+                checkpoints = [(song.checkpoint, n) if song.checkpoint is not None else None
+                               for song in todo for n in range(n_tracks)]
+                stage2_tracks = self.stage2_inference(
+                    self.model_stage2, tracks, batch_size=min(song.job.stage2_batch_size for song in todo), progress=stage2_progress,
+                    on_codes=lambda track, codes: decoders[id(todo[track // n_tracks])].push(track % n_tracks, codes),
+                    checkpoints=checkpoints)
+                print('Stage 2 DONE.\n')
+                for n, song in enumerate(todo):
+                    song.stage2_tracks = stage2_tracks[n * n_tracks:(n + 1) * n_tracks]
+                    if song.checkpoint is not None:
+                        song.checkpoint.save("stage2", "tracks", song.stage2_tracks)
+                    self._write_tracks(song.writes, song.job, song.stage2_output_set, song.stage2_tracks, song.keys.get("stage2"))
+            for song in decoding:
+                if song in todo:
+                    continue
+                for start_frame in range(0, max(track.shape[-1] for track in song.stage2_tracks), STAGE2_CHUNK_FRAMES):
+                    for n, track in enumerate(song.stage2_tracks):
+                        decoders[id(song)].push(n, track[:, start_frame:start_frame + STAGE2_CHUNK_FRAMES])
+            for song in decoding:
+                song.decoded = decoders[id(song)].finish()
+                if song.checkpoint is not None:
+                    song.checkpoint.save("final", "decoded", song.decoded)
+            decoded = [song.decoded for song in songs]
+        elapsed = time.perf_counter() - start
+        for song, audio in zip(songs, decoded):
+            song.timings["stage2_decode"] = elapsed
+            self._write_outputs(song, self.mix(song.job, audio))
+
+    def _run_pipelined(self, song, progress, audio_sink=None):
+        """Stage 1, stage 2 and the decoders of one song at the same time, as a pipeline.
+
+        Stage 2 and the decoders each run on a worker thread (and CUDA stream)
+        of their own: every stage-1 segment is handed to stage 2 as soon as it
+        is sampled, and every stage-2 chunk to the decoders as soon as it is
+        generated, while stage 1 samples the next segment. Chunks start at the
+        same 6 s boundaries as in the phased run, so the codes are the same;
+        only the tail of each track waits for the last segment.
+        """
+        job = song.job
+        n_tracks = len(STAGE_TRACK_NAMES)
+        # the length is only known once stage 1 is done; progress counts against the longest possible song
+        decoder = self.song_decoder(job, [job.run_n_segments * job.max_new_tokens // 2] * n_tracks, progress, audio_sink)
+        chunks = [{} for _ in range(n_tracks)]
+        planned = [0] * n_tracks    # frames of each track handed to stage 2
+        done = [0, 0]               # stage-2 batches done, planned
+        checkpoints = [(song.checkpoint, n) for n in range(n_tracks)] if song.checkpoint is not None else None
+
+        def stage2(item):
+            tracks, final = item
+            prompts = [track.astype(np.int32) for track in tracks]
+            # the full chunks that are new since the last call; the tails once stage 1 is done
+            lengths = [prompt.shape[-1] - planned[track] for track, prompt in enumerate(prompts)]
+            if not final:
+                lengths = [length - length % STAGE2_CHUNK_FRAMES for length in lengths]
+            batches = [[(track, planned[track] + start, planned[track] + end) for track, start, end in batch]
+                       for batch in plan_stage2_batches(lengths, job.stage2_batch_size, STAGE2_CHUNK_FRAMES)]
+            for track, length in enumerate(lengths):
+                planned[track] += length
+            done[1] += len(batches)
+            for batch in batches:
+                for (track, start, _), output in zip(batch, self._stage2_batch(self.model_stage2, prompts, batch, checkpoints)):
+                    chunks[track][start] = codes = self._stage2_codes(output)
+                    decode.put((track, codes))
+                done[0] += 1
+                progress("stage2", done[0], done[1])
+
+        with self.residency.use(*STAGE2_MODELS):
+            decode = PipelineStage("yue-decode", metrics.bind(lambda item: decoder.push(*item)), self.stage2_device)
+            stage2_worker = PipelineStage("yue-stage2", metrics.bind(stage2), self.stage2_device)
+            errors = []
+            try:
+                self._run_stage1(song, progress, on_tracks=lambda tracks: stage2_worker.put((tracks, False)))
+                start = time.perf_counter()
+                stage2_worker.put((song.stage1_tracks, True))
+            except BaseException as e:
+                errors.append(e)
+            # every worker is closed and joined, whichever stage failed; after a failure they drop
+            # what is left, and the first error is raised
+            for stage in (stage2_worker, decode):
+                stage.close(drop=bool(errors))
+                try:
+                    stage.join()
+                except BaseException as e:
+                    errors.append(e)
+            if errors:
+                raise errors[0]
+            decoder.total_frames = min(track.shape[-1] for track in song.stage1_tracks)
+            song.decoded = decoder.finish()
+        song.stage2_tracks = [self._stage2_track(track_chunks) for track_chunks in chunks]
+        if song.checkpoint is not None:
+            song.checkpoint.save("stage2", "tracks", song.stage2_tracks)
+            song.checkpoint.save("final", "decoded", song.decoded)
+        self._write_tracks(song.writes, job, song.stage2_output_set, song.stage2_tracks, song.keys.get("stage2"))
+        # only what the pipeline could not overlap with stage 1
+        song.timings["stage2_decode"] = time.perf_counter() - start
+        self._write_outputs(song, self.mix(job, song.decoded))
+
+    def _write_outputs(self, song, audio):
+        job, outputs, writes = song.job, song.outputs, song.writes
+        if job.keep_intermediate:
+            recons_output_dir = os.path.join(job.output_dir, "recons")
+            vocoder_stems_dir = os.path.join(job.output_dir, 'vocoder', 'stems')
+            for path, recons in zip(song.stage2_output_set, audio["recons"]):
+                recons_path = os.path.join(recons_output_dir, os.path.splitext(os.path.basename(path))[0] + ".mp3")
+                writes.append(self._writer.submit(save_audio, recons, recons_path, 16000))
+            for vocoded, stem in zip(audio["vocoder"], STAGE_TRACK_NAMES):
+                stem_path = os.path.join(vocoder_stems_dir, stem.replace('.npy', '.mp3'))
+                writes.append(self._writer.submit(save_audio, vocoded, stem_path, 44100, job.rescale))
+            writes.append(self._writer.submit(save_audio, audio["recons_mix"], outputs["recons_mix"], 16000))
+        if audio["vocoder_mix"] is None:
+            outputs["vocoder_mix"] = outputs["final_mix"] = None
+        else:
+            writes.append(self._writer.submit(save_audio, audio["vocoder_mix"], outputs["vocoder_mix"], 44100, job.rescale))
+            writes.append(self._writer.submit(save_audio, audio["final_mix"], outputs["final_mix"], 44100))
+        song.finished = True
+
+    def _prune_checkpoints(self, song):
+        """Mark the song's checkpoint dirs as in use and drop old progress of other songs."""
+        with self._checkpoint_lock:
+            song.keys_in_use = song.checkpoint.keys
+            self._active_checkpoints.update(song.keys_in_use)
+            prune_checkpoints(self.args.checkpoint_dir, int(self.args.checkpoint_max_gb * 1024**3),
+                              self.args.checkpoint_max_age_hours * 3600, keep=set(self._active_checkpoints))
+
+    def _close_song(self, song):
+        """Wait for the song's background writes, then cache its final mix."""
+        if song.keys_in_use:
+            with self._checkpoint_lock:
+                for key in song.keys_in_use:
+                    self._active_checkpoints[key] -= 1
+                    if self._active_checkpoints[key] <= 0:
+                        del self._active_checkpoints[key]
+            song.keys_in_use = ()
+        # outputs (and the files cache entries link to) must exist before the caller sees them
+        writes, song.writes = song.writes, []
+        for write in writes:
+            write.result()
+        song.timings["total"] = time.perf_counter() - song.started
+        status = "failed" if song.outputs is None else "done" if song.finished else "interrupted"
+        metrics.REGISTRY.inc("songs_total", status=status)
+        for phase, seconds in song.timings.items():
+            metrics.REGISTRY.observe("phase_seconds", seconds, phase=phase)
+        if status == "done":
+            song.metrics.write(song.outputs["timings"], song.timings)
+        # nothing new to report for failed or interrupted songs and final-mix cache hits
+        if status != "done" or "stage2_decode" not in song.timings:
+            return
+        if song.outputs["vocoder_mix"]:
+            print(f"Created mix: {song.outputs['vocoder_mix']}")
+        if song.keys and song.outputs["vocoder_mix"]:
+            self.cache.put(song.keys["final"], {FINAL_OUTPUT_NAMES[name]: song.outputs[name] for name in FINAL_OUTPUT_NAMES})
+        if song.checkpoint is not None:
+            song.checkpoint.clear()
+
+    def _cached_tracks(self, key):
+        """Vocal/instrumental token arrays of a cached stage entry, or None on miss."""
+        files = self.cache.get(key, STAGE_TRACK_NAMES) if key else None
+        if files is None:
+            return None
+        try:
+            return [np.load(files[name]) for name in STAGE_TRACK_NAMES]
+        except FileNotFoundError:
+            # evicted by a concurrent put() in between
+            return None
+
+    @staticmethod
+    def _checkpointed_tracks(song, level):
+        """Vocal/instrumental token arrays of a finished stage of an interrupted run, or None."""
+        return song.checkpoint.load(level, "tracks") if song.checkpoint is not None else None
+
+    def _write_tracks(self, writes, job, paths, tracks, key=None):
+        """Save stage token arrays in the background if intermediates are kept or
+        the result cache needs them, then add them to the cache."""
+        if not job.keep_intermediate and key is None:
+            return
+
+        def write():
+            for path, track in zip(paths, tracks):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                np.save(path, track)
+            if key is not None:
+                self.cache.put(key, dict(zip(STAGE_TRACK_NAMES, paths)))
+        writes.append(self._writer.submit(write))
+
+    def prompt_codes(self, path, first_frame, last_frame, target_bw=0.5):
+        """xcodec codes (n_codebooks, n_frames) of the codec frames [first_frame, last_frame) of an audio file.
+
+        Only that range plus PROMPT_CONTEXT_FRAMES on either side is loaded,
+        resampled and encoded. The codes are kept by file content, range and
+        bandwidth, in memory and in the result cache, so a reference track
+        that many requests share is encoded once.
+        """
+        key = cache_key("prompt", prompt_digest(path), first_frame, last_frame, target_bw, self.args.resume_path)
+        with self._prompt_lock:
+            if key in self._prompt_codes:
+                self._prompt_codes.move_to_end(key)
+                return self._prompt_codes[key]
+        codes = None
+        files = self.cache.get(key, ["codes.npy"]) if self.cache is not None else None
+        if files is not None:
+            try:
+                codes = np.load(files["codes.npy"])
+            except FileNotFoundError:
+                pass  # evicted by a concurrent put() in between
+        if codes is None:
+            start = max(0, first_frame - PROMPT_CONTEXT_FRAMES)
+            with metrics.span("prompt_encode", frames=last_frame - first_frame):
+                audio = load_audio_mono(path, start_time=start / CODEC_FRAME_RATE,
+                                        end_time=(last_frame + PROMPT_CONTEXT_FRAMES) / CODEC_FRAME_RATE)
+                codes = encode_audio(self.codec_model, audio, self.stage2_device, target_bw=target_bw)[0]
+            codes = np.ascontiguousarray(codes[:, first_frame - start:last_frame - start])
+            if self.cache is not None:
+                with tempfile.TemporaryDirectory() as tmp:
+                    np.save(os.path.join(tmp, "codes.npy"), codes)
+                    self.cache.put(key, {"codes.npy": os.path.join(tmp, "codes.npy")})
+        with self._prompt_lock:
+            self._prompt_codes[key] = codes
+            while len(self._prompt_codes) > PROMPT_CACHE_ENTRIES:
+                self._prompt_codes.popitem(last=False)
+        return codes
+
+    def stage1_inference(self, job, lyrics_text, genres, progress=no_progress, checkpoint=None, on_tracks=None):
+        """Returns the stage-1 [vocals, instrumentals] codebook-0 arrays, each (1, n_frames).
+
+        With a JobCheckpoint, the state after every segment is saved, and an
+        interrupted run continues after the last saved segment. `on_tracks`
+        is called with the arrays of the segments sampled so far after each
+        segment, so that later stages can start on them.
+        """
+        if self.model is None:
+            raise RuntimeError("This engine was started without --stage1_model and can only reuse cached stage-1 tokens")
+        # Each song samples from its own generator, so its seed alone decides the
+        # result even when its segments are batched with other songs.
+        generator = torch.Generator(device=self.device).manual_seed(job.seed)
+        # the audio prompt is encoded with the codec
+        models = ("stage1", "codec") if job.use_audio_prompt or job.use_dual_tracks_prompt else ("stage1",)
+        if self.draft_model is not None:
+            models += ("draft",)
+        with self.residency.use(*models):
+            # stage 2 and the decoders come next; copy them over while stage 1 runs
+            self.residency.prefetch(*STAGE2_MODELS)
+            return self._stage1_inference(job, lyrics_text, genres, progress, generator, checkpoint, on_tracks)
+
+    def _stage1_inference(self, job, lyrics_text, genres, progress, generator, checkpoint=None, on_tracks=None):
+        mmtokenizer = self.mmtokenizer
+        codectool = self.codectool
+        device = self.device
+        max_new_tokens = job.max_new_tokens
+
+        # Tips:
+        # genre tags support instrumental，genre，mood，vocal timbr and vocal gender
+        # all kinds of tags are needed
+        genres = genres.strip()
+        lyrics = split_lyrics(lyrics_text)
+        # intruction
+        full_lyrics = "\n".join(lyrics)
+        prompt_texts = [f"Generate music from the given lyrics segment by segment.\n[Genre] {genres}\n{full_lyrics}"]
+        prompt_texts += lyrics
+
+
+        output_seq = None
+        past_key_values, cached_len = None, 0
+        top_p = STAGE1_TOP_P
+        temperature = STAGE1_TEMPERATURE
+        repetition_penalty = job.repetition_penalty
+        # special tokens
+        start_of_segment = mmtokenizer.tokenize('[start_of_segment]')
+        end_of_segment = mmtokenizer.tokenize('[end_of_segment]')
+        # Format text prompt
+        run_n_segments = min(job.run_n_segments+1, len(lyrics))
+        resumed = checkpoint.load("stage1", "segments") if checkpoint is not None else None
+        if resumed is not None:
+            # the KV cache is not saved; the next segment prefills its whole context once
+            print(f"Resuming Stage 1 after section {resumed['segment']}")
+            context_ids, raw_output = resumed["context_ids"].to(device), resumed["raw_output"].to(device)
+            header_len = resumed["header_len"]
+            generator.set_state(resumed["generator"])
+            if on_tracks is not None:
+                on_tracks(self._split_tracks(job, raw_output))
+        for i, p in enumerate(tqdm(prompt_texts[:run_n_segments], desc="Stage1 inference...")):
+            section_text = p.replace('[start_of_segment]', '').replace('[end_of_segment]', '')
+            guidance_scale = 1.5 if i <=1 else 1.2
+            if i==0 or (resumed is not None and i <= resumed["segment"]):
+                continue
+            if i==1:
+                if job.use_dual_tracks_prompt or job.use_audio_prompt:
+                    if job.use_dual_tracks_prompt:
+                        # the interleaved ids [begin, end) cover the frames [begin // 2, (end + 1) // 2) of each track
+                        begin, end = int(job.prompt_start_time*50*2), int(job.prompt_end_time*50*2)
+                        first_frame, last_frame = begin // 2, (end + 1) // 2
+                        vocals_ids = self.prompt_codes(job.vocal_track_prompt_path, first_frame, last_frame, target_bw=0.5)
+                        instrumental_ids = self.prompt_codes(job.instrumental_track_prompt_path, first_frame, last_frame, target_bw=0.5)
+                        vocals_ids = codectool.npy2ids(vocals_ids)
+                        instrumental_ids = codectool.npy2ids(instrumental_ids)
+                        ids_segment_interleaved = rearrange([np.array(vocals_ids), np.array(instrumental_ids)], 'b n -> (n b)')
+                        audio_prompt_codec = ids_segment_interleaved[begin - 2 * first_frame: end - 2 * first_frame]
+                        audio_prompt_codec = audio_prompt_codec.tolist()
+                    elif job.use_audio_prompt:
+                        raw_codes = self.prompt_codes(job.audio_prompt_path, int(job.prompt_start_time *50), int(job.prompt_end_time *50), target_bw=0.5) # 50 is tps of xcodec
+                        # Format audio prompt
+                        audio_prompt_codec = codectool.npy2ids(raw_codes)
+                    with metrics.span("tokenization", segment=i):
+                        audio_prompt_codec_ids = [mmtokenizer.soa] + codectool.sep_ids + audio_prompt_codec + [mmtokenizer.eoa]
+                        sentence_ids = mmtokenizer.tokenize("[start_of_reference]") +  audio_prompt_codec_ids + mmtokenizer.tokenize("[end_of_reference]")
+                        head_id = mmtokenizer.tokenize(prompt_texts[0]) + sentence_ids
+                else:
+                    with metrics.span("tokenization", segment=i):
+                        head_id = mmtokenizer.tokenize(prompt_texts[0])
+                with metrics.span("tokenization", segment=i):
+                    prompt_ids = head_id + start_of_segment + mmtokenizer.tokenize(section_text) + [mmtokenizer.soa] + codectool.sep_ids
+            else:
+                with metrics.span("tokenization", segment=i):
+                    prompt_ids = end_of_segment + start_of_segment + mmtokenizer.tokenize(section_text) + [mmtokenizer.soa] + codectool.sep_ids
+
+            prompt_ids = torch.as_tensor(prompt_ids).unsqueeze(0).to(device) 
+            if i == 1:
+                header_len = len(head_id)
+                input_ids = prompt_ids
+            else:
+                input_ids = torch.cat([context_ids, prompt_ids], dim=1)
+            # Use window slicing in case output sequence exceeds the context of model
+            max_context = 16384-max_new_tokens-1
+            if input_ids.shape[-1] > max_context:
+                # keep the instruction/genre/lyrics header as an attention sink plus the most recent tokens.
+                # The header keeps its positions, so its part of the carried cache stays valid; the windowed
+                # tokens move to new positions (RoPE is baked into their keys) and are prefilled again, for
+                # this and every later segment of a song this long.
+                keep_header = header_len if header_len < max_context // 2 else 0
+                print(f'Section {i}: output length {input_ids.shape[-1]} exceeding context length {max_context}, now using the {keep_header} header tokens and the last {max_context - keep_header} tokens.')
+                input_ids = torch.cat([input_ids[:, :keep_header], input_ids[:, -(max_context - keep_header):]], dim=1)
+                cached_len = min(cached_len, keep_header)
+                past_key_values = [(k[:, :, :cached_len], v[:, :, :cached_len]) for k, v in past_key_values] if past_key_values is not None and cached_len else None
+            request = SegmentRequest(
+                input_ids[0],
+                segment_idx=i,
+                generator=generator,
+                guidance_scale=guidance_scale,
+                max_new_tokens=max_new_tokens, 
+                min_new_tokens=100, 
+                top_p=top_p,
+                temperature=temperature, 
+                repetition_penalty=repetition_penalty, 
+                past_key_values=past_key_values,
+                cached_len=cached_len,
+                keep_cache=i < run_n_segments - 1,
+            )
+            output_seq = self.stage1_batcher.generate(request).unsqueeze(0)
+            if request.timings is not None:
+                t = request.timings
+                metrics.record("stage1_prefill", t["prefill"], segment=i, tokens=t["prefill_tokens"])
+                metrics.record("stage1_decode", t["decode"], segment=i, tokens=t["new_tokens"])
+            # carried over so the next segment only prefills its own prompt
+            past_key_values, cached_len = request.past_key_values, request.cached_len
+            if request.draft_stats is not None:
+                stats = request.draft_stats
+                print(f'Section {i}: draft acceptance {stats["accepted"] / max(1, stats["proposed"]):.2f}, '
+                      f'{(output_seq.shape[-1] - input_ids.shape[-1]) / max(1, stats["target_passes"]):.2f} tokens per Stage 1 pass')
+            # CodecFraming guarantees an even-length codec run closed by eoa
+            context_ids = output_seq
+            if i > 1:
+                raw_output = torch.cat([raw_output, prompt_ids, output_seq[:, input_ids.shape[-1]:]], dim=1)
+            else:
+                raw_output = output_seq
+            if checkpoint is not None:
+                checkpoint.save("stage1", "segments", {
+                    "segment": i, "context_ids": context_ids.cpu(), "raw_output": raw_output.cpu(),
+                    "header_len": header_len, "generator": generator.get_state(),
+                })
+            progress("stage1", i, run_n_segments - 1)
+            if on_tracks is not None:
+                on_tracks(self._split_tracks(job, raw_output))
+
+        return self._split_tracks(job, raw_output)
+
+    def _split_tracks(self, job, raw_output):
+        """The [vocals, instrumentals] codebook-0 arrays of the segments sampled into raw_output."""
+        mmtokenizer = self.mmtokenizer
+        codectool = self.codectool
+        # check sanity (only the prompt could break the pairing now)
+        # a copy: on the cpu the array would share memory with raw_output, which stage 1 still extends
+        ids = raw_output[0].cpu().numpy().copy()
+        soa_idx = np.where(ids == mmtokenizer.soa)[0].tolist()
+        eoa_idx = np.where(ids == mmtokenizer.eoa)[0].tolist()
+        if len(soa_idx)!=len(eoa_idx):
+            raise ValueError(f'invalid pairs of soa and eoa, Num of soa: {len(soa_idx)}, Num of eoa: {len(eoa_idx)}')
+
+        vocals = []
+        instrumentals = []
+        range_begin = 1 if job.use_audio_prompt or job.use_dual_tracks_prompt else 0
+        for i in range(range_begin, len(soa_idx)):
+            codec_ids = ids[soa_idx[i]+1:eoa_idx[i]]
+            if codec_ids[0] == 32016:
+                codec_ids = codec_ids[1:]
+            vocals_ids = codectool.ids2npy(rearrange(codec_ids,"(n b) -> b n", b=2)[0])
+            vocals.append(vocals_ids)
+            instrumentals_ids = codectool.ids2npy(rearrange(codec_ids,"(n b) -> b n", b=2)[1])
+            instrumentals.append(instrumentals_ids)
+        vocals = np.concatenate(vocals, axis=1)
+        instrumentals = np.concatenate(instrumentals, axis=1)
+        return [vocals, instrumentals]
+
+    def stage2_generate(self, model, chunks):
+        """Teacher-force a batch of equal-length stage-1 chunks, each (1, n_frames),
+        through stage 2 and return one flattened (8 * n_frames,) token array per chunk."""
+        mmtokenizer = self.mmtokenizer
+        codectool = self.codectool
+        batch_size = len(chunks)
+        codec_ids = np.concatenate([
+            codectool.offset_tok_ids(
+                codectool.unflatten(chunk, n_quantizer=1), 
+                global_offset=codectool.global_offset, 
+                codebook_size=codectool.codebook_size, 
+                num_codebooks=codectool.num_codebooks, 
+            ).astype(np.int32)
+            for chunk in chunks
+        ], axis=0)
+        prompt_ids = np.concatenate(
+            [
+                np.tile([mmtokenizer.soa, mmtokenizer.stage_1], (batch_size, 1)),
+                codec_ids,
+                np.tile([mmtokenizer.stage_2], (batch_size, 1)),
+            ],
+            axis=1
+        )
+
+        codec_ids = torch.as_tensor(codec_ids).to(self.stage2_device)
+        prompt_ids = torch.as_tensor(prompt_ids).to(self.stage2_device)
+        len_prompt = prompt_ids.shape[-1]
+        
+        # Teacher forcing generate loop, incremental over one KV cache
+        prompt_ids = Stage2Decoder(model, 46358, 53526, mmtokenizer.vocab_size).decode(prompt_ids, codec_ids)
+
+        output = prompt_ids.cpu().numpy()[:, len_prompt:]
+        return [output[i] for i in range(batch_size)]
+
+    def stage2_inference(self, model, stage1_tracks, batch_size=4, progress=no_progress, on_codes=None, checkpoints=None):
+        """Stage-1 token arrays in, stage-2 (n_codebooks, n_frames) code arrays out, in the same order.
+
+        `on_codes(track, codes)` is called with each track's codes in order as soon
+        as they are contiguous, so decoding can start before stage 2 finishes.
+        Invalid codes are repaired chunk by chunk (see `_stage2_codes`), and the
+        returned arrays are those same chunks, so the streamed audio, the saved
+        tokens and the cached or checkpointed tracks always agree.
+
+        `checkpoints` may give a (JobCheckpoint, track index within its song)
+        pair per track: every generated chunk is saved, and batches whose
+        chunks are all saved already are loaded instead of generated.
+        """
+        prompts = [track.astype(np.int32) for track in stage1_tracks]
+
+        # Chunks of every track (vocal and instrumental, tails included) share batches
+        batches = plan_stage2_batches([prompt.shape[-1] for prompt in prompts], batch_size, STAGE2_CHUNK_FRAMES)
+        track_chunks = [{} for _ in prompts]
+        next_start = [0] * len(prompts)
+        for n, batch in enumerate(tqdm(batches)):
+            outputs = self._stage2_batch(model, prompts, batch, checkpoints)
+            for (track, start, _), output in zip(batch, outputs):
+                track_chunks[track][start] = self._stage2_codes(output)
+            progress("stage2", n + 1, len(batches))
+            if on_codes is None:
+                continue
+            for track, chunks in enumerate(track_chunks):
+                while next_start[track] in chunks:
+                    codes = chunks[next_start[track]]
+                    on_codes(track, codes)
+                    next_start[track] += codes.shape[-1]
+
+        return [self._stage2_track(chunks) for chunks in track_chunks]
+
+    def _stage2_batch(self, model, prompts, batch, checkpoints=None):
+        """Stage-2 output ids of one planned batch of (track, start, end) chunks of `prompts`,
+        loaded from the tracks' checkpoints if all of them are saved there."""
+        def chunk_checkpoint(track):
+            return checkpoints[track] if checkpoints is not None and checkpoints[track] is not None else (None, None)
+        saved = []
+        for track, start, _ in batch:
+            checkpoint, local = chunk_checkpoint(track)
+            saved.append(checkpoint.load("stage2", f"chunk_{local}_{start}") if checkpoint is not None else None)
+        if all(output is not None for output in saved):
+            return saved
+        with metrics.span("stage2_chunk", chunks=len(batch), frames=sum(end - start for _, start, end in batch)):
+            outputs = self.stage2_generate(model, [prompts[track][:, start:end] for track, start, end in batch])
+        for (track, start, _), output in zip(batch, outputs):
+            checkpoint, local = chunk_checkpoint(track)
+            if checkpoint is not None:
+                checkpoint.save("stage2", f"chunk_{local}_{start}", output)
+        return outputs
+
+    def _stage2_codes(self, output):
+        """(n_codebooks, n_frames) codes of one chunk's stage-2 output ids, invalid codes repaired."""
+        codes = self.codectool_stage2.ids2npy(output)
+
+        # Fix invalid codes (a dirty solution, which may harm the quality of audio)
+        # We are trying to find better one. Per chunk, so that streamed and saved codes are the same.
+        metrics.count("invalid_codes_repaired", fix_invalid_codes(codes))
+        return codes
+
+    @staticmethod
+    def _stage2_track(chunks):
+        """One track's (n_codebooks, n_frames) codes from its {start: codes} stage-2 chunks."""
+        return np.concatenate([chunks[start] for start in sorted(chunks)], axis=1)
+
+    def vocode(self, codes, decoder):
+        """Upsample one track's stage-2 codes (n_codebooks, n_frames) to 44.1 kHz
+        with a Vocos decoder; the in-memory equivalent of vocoder.process_audio."""
+        with metrics.span("vocoder", frames=codes.shape[-1]):
+            compressed = torch.as_tensor(codes.astype(np.int16), dtype=torch.long).unsqueeze(1).to(self.stage2_device)
+            with torch.no_grad():
+                embed = self.codec_model.get_embed(compressed)
+                out = decoder(torch.as_tensor(embed).to(self.stage2_device))
+            return out.detach().cpu().reshape(1, -1)
+
+    def codec_decode(self, codes):
+        """16 kHz xcodec reconstruction of (n_codebooks, n_frames) codes, as (1, samples)."""
+        with metrics.span("codec_decode", frames=codes.shape[-1]), torch.no_grad():
+            decoded_waveform = self.codec_model.decode(torch.as_tensor(codes.astype(np.int16), dtype=torch.long).unsqueeze(0).permute(1, 0, 2).to(self.stage2_device))
+            return decoded_waveform.cpu().reshape(1, -1)
+
+    def song_decoder(self, job, track_lengths, progress=no_progress, audio_sink=None):
+        """Streaming codec reconstruction and vocoder upsampling of the [vocal, instrumental] tracks."""
+        return SongDecoder(
+            recons_decoders=[ChunkedDecoder(self.codec_decode, 16000 // CODEC_FRAME_RATE, STAGE2_CHUNK_FRAMES)
+                             for _ in track_lengths],
+            vocoder_decoders=[ChunkedDecoder(lambda codes, decoder=decoder: self.vocode(codes, decoder), 44100 // CODEC_FRAME_RATE, STAGE2_CHUNK_FRAMES)
+                              for decoder in (self.vocal_decoder, self.inst_decoder)],
+            sink=audio_sink,
+            progress=progress,
+            total_frames=min(track_lengths),
+            keep_stems=job.keep_intermediate,
+        )
+
+    def mix(self, job, audio):
+        """Limit the vocoder mix and build the final mix from SongDecoder.finish() output."""
+        audio["final_mix"] = None
+        if audio["vocoder_mix"] is None:
+            return audio
+        with metrics.span("post_process"):
+            audio["vocoder_mix"] = limit_audio(audio["vocoder_mix"], job.rescale)
+            # Post process
+            audio["final_mix"] = replace_low_freq(
+                audio["recons_mix"],        # 16kHz
+                16000,
+                audio["vocoder_mix"],       # 44.1kHz
+                44100,
+                cutoff_freq=5500.0
+            )
+        return audio